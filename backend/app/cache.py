@@ -0,0 +1,53 @@
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from redis import asyncio as aioredis
+import redis
+import os
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+CACHE_PREFIX = "sp"
+STATS_NAMESPACE = "stats"
+# Les récoltes changent au plus une fois par jour (import)
+STATS_EXPIRE = 3600
+VARIETIES_NAMESPACE = "varieties"
+# Les variétés ne changent quasiment jamais (import), le cache est aussi vidé à chaque ajout
+VARIETIES_EXPIRE = 3600
+
+
+def init_cache():
+    """Initialise le cache des réponses (Redis)"""
+    FastAPICache.init(RedisBackend(aioredis.from_url(REDIS_URL)), prefix=CACHE_PREFIX)
+
+
+def query_key_builder(func, namespace: str = "", *, request=None, response=None, args=(), kwargs=None):
+    """
+    Clé de cache construite sur les seuls paramètres de requête
+    (la session DB injectée change à chaque appel et ne doit pas entrer dans la clé)
+    """
+    params = ":".join(f"{k}={v}" for k, v in sorted((kwargs or {}).items()) if k != "db")
+    return f"{FastAPICache.get_prefix()}:{namespace}:{func.__name__}:{params}"
+
+
+def clear_cache(namespace: str):
+    """
+    Vide les réponses en cache d'un namespace
+    Client Redis synchrone : utilisable depuis les scripts d'import
+    """
+    try:
+        client = redis.Redis.from_url(REDIS_URL)
+        keys = list(client.scan_iter(f"{CACHE_PREFIX}:{namespace}:*"))
+        if keys:
+            client.delete(*keys)
+    except redis.RedisError as e:
+        print(f"⚠️  Cache '{namespace}' non vidé ({e})")
+
+
+def clear_stats_cache():
+    """Vide le cache des statistiques (à appeler après une modification des récoltes)"""
+    clear_cache(STATS_NAMESPACE)
+
+
+def clear_varieties_cache():
+    """Vide le cache des variétés (à appeler après un ajout ou une modification de variété)"""
+    clear_cache(VARIETIES_NAMESPACE)
\ No newline at end of file
@@ -1,6 +1,9 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from typing import AsyncIterator
+import asyncio
 import os
 
 POSTGRES_USER = os.getenv("POSTGRES_USER")
@@ -10,15 +13,51 @@ POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 
-engine = create_engine(DATABASE_URL)
+# Dimensionnement explicite du pool (le défaut 5 + 10 sature sous une rafale de requêtes)
+POOL_SIZE = 20
+POOL_OPTIONS = dict(
+    pool_size=POOL_SIZE,
+    max_overflow=20,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=3600
+)
+
+# Cache des requêtes SQL compilées (défaut 500 ; les lambda_stmt des routes y sont conservés)
+QUERY_CACHE_SIZE = 1200
+
+# executemany des INSERT envoyés en VALUES multi-lignes par lots de INSERT_PAGE_SIZE (imports)
+INSERT_PAGE_SIZE = 1000
+
+# Moteur synchrone : scripts (import, météo, dataset, entraînement, prédictions)
+engine = create_engine(
+    DATABASE_URL,
+    query_cache_size=QUERY_CACHE_SIZE,
+    executemany_mode='values_plus_batch',
+    insertmanyvalues_page_size=INSERT_PAGE_SIZE,
+    **POOL_OPTIONS
+)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Moteur asynchrone (asyncpg) : routes de l'API
+async_engine = create_async_engine(ASYNC_DATABASE_URL, query_cache_size=QUERY_CACHE_SIZE, **POOL_OPTIONS)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
\ No newline at end of file
+async def warm_pool():
+    """Ouvre POOL_SIZE connexions au démarrage pour que la première rafale ne paie pas les handshakes"""
+    conns = await asyncio.gather(*(async_engine.connect() for _ in range(POOL_SIZE)))
+    await asyncio.gather(*(conn.close() for conn in conns))
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """Session par requête : les routes committent elles-mêmes, toute erreur annule la transaction"""
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
\ No newline at end of file
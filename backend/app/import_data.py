@@ -1,77 +1,101 @@
 import pandas as pd
 from sqlalchemy.orm import Session
+from sqlalchemy import exists
 from datetime import datetime
 from .database import SessionLocal, engine
 from .models import Variety, HarvestRecord, Base
+from .cache import clear_stats_cache, clear_varieties_cache
 
 Base.metadata.create_all(bind=engine)
 
 def import_varieties(db: Session):
     """Importe les variétés dans la base de données"""
     varieties_names = ["Clery", "Ciflorette", "Manon", "Dream"]
+    added = 0
     for name in varieties_names:
         # Vérifie si la variété existe déjà
-        existing = db.query(Variety).filter(Variety.name == name).first()
+        existing = db.query(exists().where(Variety.name == name)).scalar()
         if not existing:
             variety = Variety(name=name)
             db.add(variety)
+            added += 1
             print(f"✅ Variété '{name}' ajoutée")
         else:
             print(f"⏭️  Variété '{name}' existe déjà")
             
     db.commit()
+    
+    # La liste des variétés en cache n'est plus à jour
+    if added > 0:
+        clear_varieties_cache()
+    
     print("\n✅ Import des variétés terminé\n")
     
 def import_harvest_data(db: Session, excel_file: str):
     """Importe les données de récolte depuis le fichier Excel"""
     
-    # Lire toutes les feuilles Excel
-    excel_data = pd.ExcelFile(excel_file)
     variety_sheets = ["Clery", "Ciflorette", "Manon", "Dream"]
     
     total_imported = 0
     
-    for sheet_name in variety_sheets:
-        if sheet_name not in excel_data.sheet_names:
-            print(f"⚠️  Feuille '{sheet_name}' non trouvée")
-            continue
-        
-        print(f"📊 Import de '{sheet_name}'...")
-        
-        # Récupérer la variété
-        variety = db.query(Variety).filter(Variety.name == sheet_name).first()
-        if not variety:
-            print(f"❌ Variété '{sheet_name}' non trouvée en base")
-            continue
-        
-        # Lire la feuille
-        df = pd.read_excel(excel_file, sheet_name=sheet_name)
-        
-        # Importer chaque ligne
-        for _, row in df.iterrows():
-            # Vérifier si l'enregistrement existe déjà
-            existing = db.query(HarvestRecord).filter(
-                HarvestRecord.variety_id == variety.id,
-                HarvestRecord.date == pd.to_datetime(row['Date']).date()
-            ).first()
+    # Couples (variété, date) déjà en base, récupérés en une seule requête
+    existing_pairs = set(db.query(HarvestRecord.variety_id, HarvestRecord.date).all())
+    
+    # Lire toutes les feuilles Excel (classeur ouvert une seule fois, lecteur calamine en Rust)
+    with pd.ExcelFile(excel_file, engine='calamine') as excel_data:
+        for sheet_name in variety_sheets:
+            if sheet_name not in excel_data.sheet_names:
+                print(f"⚠️  Feuille '{sheet_name}' non trouvée")
+                continue
             
-            if existing:
-                continue  # On saute les doublons
+            print(f"📊 Import de '{sheet_name}'...")
             
-            # Créer l'enregistrement
-            harvest = HarvestRecord(
-                date=pd.to_datetime(row['Date']).date(),
-                day_number=int(row['Jour']) if pd.notna(row['Jour']) else 1,  # ✅ AJOUTÉ
-                plants_nbrs=int(row['Plants']) if pd.notna(row['Plants']) else 0,
-                kg_produced=float(row['Kg produits']) if pd.notna(row['Kg produits']) else 0.0,
-                year=int(row['Année']),  # ✅ CORRIGÉ (virgule manquante)
-                variety_id=variety.id
-            )
-            db.add(harvest)
-            total_imported += 1
-        
-        db.commit()
-        print(f"✅ '{sheet_name}' importé")
+            # Récupérer l'id de la variété (seule colonne utile)
+            variety_id = db.query(Variety.id).filter(Variety.name == sheet_name).scalar()
+            if variety_id is None:
+                print(f"❌ Variété '{sheet_name}' non trouvée en base")
+                continue
+            
+            # Lire la feuille
+            df = excel_data.parse(sheet_name)
+            
+            # Conversion des dates en une seule passe
+            df['Date'] = pd.to_datetime(df['Date']).dt.date
+            
+            # Colonnes converties en une seule passe (valeurs par défaut si vide)
+            dates = df['Date'].tolist()
+            jours = df['Jour'].fillna(1).astype(int).tolist()
+            plants = df['Plants'].fillna(0).astype(int).tolist()
+            kgs = df['Kg produits'].fillna(0.0).astype(float).tolist()
+            annees = df['Année'].astype(int).tolist()
+            
+            # Importer chaque ligne
+            rows = []
+            for row_date, jour, plants_nbrs, kg, annee in zip(dates, jours, plants, kgs, annees):
+                # Vérifier si l'enregistrement existe déjà
+                if (variety_id, row_date) in existing_pairs:
+                    continue  # On saute les doublons
+                existing_pairs.add((variety_id, row_date))
+                
+                # Créer l'enregistrement
+                rows.append({
+                    "date": row_date,
+                    "day_number": jour,
+                    "plants_nbrs": plants_nbrs,
+                    "kg_produced": kg,
+                    "year": annee,
+                    "variety_id": variety_id
+                })
+                total_imported += 1
+            
+            # Insertion groupée, sans créer d'objets ORM
+            db.bulk_insert_mappings(HarvestRecord, rows)
+            db.commit()
+            print(f"✅ '{sheet_name}' importé")
+    
+    # Les statistiques en cache ne reflètent plus les récoltes
+    if total_imported > 0:
+        clear_stats_cache()
     
     print(f"\n🎉 Import terminé : {total_imported} enregistrements ajoutés\n")
     
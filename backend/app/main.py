@@ -1,15 +1,26 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from .database import engine, Base
+from .database import engine, Base, warm_pool
 from . import models
 from .routes import router
+from .cache import init_cache
 
 Base.metadata.create_all(bind=engine)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_cache()
+    await warm_pool()
+    yield
+
 app = FastAPI(
     title="Strawberry Predictor API",
     description="API de prédiction de production de fraises",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # Encodage JSON en C (orjson), dates natives
 )
 
 app.add_middleware(
@@ -3,6 +3,12 @@ from sqlalchemy.orm import Session
 from .database import SessionLocal
 from .models import HarvestRecord, WeatherData, Variety
 import numpy as np
+from contextlib import redirect_stdout
+import io
+import sys
+
+# Nombre de lignes lues par bloc depuis la base
+READ_CHUNK_SIZE = 50_000
 
 def create_ml_dataset():
     """
@@ -31,7 +37,11 @@ def create_ml_dataset():
             Variety.name.label('variety')
         ).join(Variety)
         
-        harvests_df = pd.read_sql(harvests_query.statement, db.bind)
+        # Lecture par blocs via un curseur serveur : le résultat SQL n'est
+        # jamais matérialisé en entier à côté du DataFrame
+        connection = db.connection(execution_options={'stream_results': True})
+        chunks = pd.read_sql(harvests_query.statement, connection, chunksize=READ_CHUNK_SIZE)
+        harvests_df = pd.concat(chunks, ignore_index=True, copy=False)
         
         print(f"   ✅ {len(harvests_df)} enregistrements de récolte récupérés")
         print(f"   📋 Variétés : {harvests_df['variety'].unique().tolist()}")
@@ -54,7 +64,16 @@ def create_ml_dataset():
         harvests_df['date'] = pd.to_datetime(harvests_df['date'])
         weather_df['date'] = pd.to_datetime(weather_df['date'])
         
-        dataset = pd.merge(harvests_df, weather_df, on='date', how='left')
+        # Météo unique par date : jointure sur index trié plutôt qu'un merge sur colonne
+        weather_df = weather_df.set_index('date').sort_index()
+        dataset = harvests_df.set_index('date').join(weather_df, how='left').reset_index()
+        
+        # Valeurs capteurs/pesées : la précision float32 suffit et divise
+        # par deux la mémoire parcourue par les moyennes glissantes
+        float_cols = dataset.select_dtypes('float64').columns
+        dataset[float_cols] = dataset[float_cols].astype('float32')
+        int_cols = dataset.select_dtypes('int64').columns
+        dataset[int_cols] = dataset[int_cols].astype('int32')
         
         print(f"   ✅ {len(dataset)} lignes après fusion")
         
@@ -65,24 +84,29 @@ def create_ml_dataset():
         
         dataset = dataset.sort_values(['variety', 'date'])
         
-        for variety in dataset['variety'].unique():
-            mask = dataset['variety'] == variety
-            
+        # Feature glissante sur 7 jours -> (colonne source, agrégation)
+        rolling_features = {
             # Moyennes météo sur 7 jours
-            dataset.loc[mask, 'temp_mean_7d'] = dataset.loc[mask, 'temperature_mean'].rolling(7, min_periods=1).mean()
-            dataset.loc[mask, 'humidity_mean_7d'] = dataset.loc[mask, 'humidity_mean'].rolling(7, min_periods=1).mean()
-            dataset.loc[mask, 'precipitation_7d_sum'] = dataset.loc[mask, 'precipitation'].rolling(7, min_periods=1).sum()
-            dataset.loc[mask, 'sunshine_7d_sum'] = dataset.loc[mask, 'sunshine_duration'].rolling(7, min_periods=1).sum()
-            dataset.loc[mask, 'solar_radiation_7d_mean'] = dataset.loc[mask, 'solar_radiation'].rolling(7, min_periods=1).mean()
-            
+            'temp_mean_7d': ('temperature_mean', 'mean'),
+            'humidity_mean_7d': ('humidity_mean', 'mean'),
+            'precipitation_7d_sum': ('precipitation', 'sum'),
+            'sunshine_7d_sum': ('sunshine_duration', 'sum'),
+            'solar_radiation_7d_mean': ('solar_radiation', 'mean'),
             # Production observée des 7 derniers jours
-            dataset.loc[mask, 'kg_produced_7d_mean'] = dataset.loc[mask, 'kg_produced'].rolling(7, min_periods=1).mean()
-            dataset.loc[mask, 'kg_produced_7d_sum'] = dataset.loc[mask, 'kg_produced'].rolling(7, min_periods=1).sum()
-            
-            # Production du jour précédent
-            dataset.loc[mask, 'kg_produced_prev_day'] = dataset.loc[mask, 'kg_produced'].shift(1)
+            'kg_produced_7d_mean': ('kg_produced', 'mean'),
+            'kg_produced_7d_sum': ('kg_produced', 'sum')
+        }
+        
+        # Dataset trié par variété : le groupby (sort=False) rend les lignes
+        # dans le même ordre, on assigne donc directement les valeurs
+        by_variety = dataset.groupby('variety', sort=False)
+        for feature, (column, how) in rolling_features.items():
+            dataset[feature] = by_variety[column].rolling(7, min_periods=1).agg(how).to_numpy()
         
-        print(f"   ✅ Moyennes glissantes calculées pour {len(dataset['variety'].unique())} variétés")
+        # Production du jour précédent
+        dataset['kg_produced_prev_day'] = by_variety['kg_produced'].shift(1)
+        
+        print(f"   ✅ Moyennes glissantes calculées pour {by_variety.ngroups} variétés")
         
         
         
@@ -94,17 +118,17 @@ def create_ml_dataset():
         dataset['day_of_week'] = pd.to_datetime(dataset['date']).dt.dayofweek
         # Définir la fraction de plants récoltés par jour de semaine
         # 0=Lundi, 1=Mardi, 2=Mercredi, 3=Jeudi, 4=Vendredi, 5=Samedi, 6=Dimanche
-        harvest_fraction = {
-            0: 1/3,  # Lundi
-            1: 1/3,  # Mardi
-            2: 1/3,  # Mercredi
-            3: 1/2,  # Jeudi
-            4: 1/2,  # Vendredi
-            5: 1/2,  # Samedi
-            6: 0     # Dimanche (sera filtré plus tard)
-        }
-        # Appliquer la fraction correspondante
-        dataset['harvest_fraction'] = dataset['day_of_week'].map(harvest_fraction)
+        harvest_fraction = np.array([
+            1/3,  # Lundi
+            1/3,  # Mardi
+            1/3,  # Mercredi
+            1/2,  # Jeudi
+            1/2,  # Vendredi
+            1/2,  # Samedi
+            0     # Dimanche (sera filtré plus tard)
+        ])
+        # Appliquer la fraction correspondante (indexée par day_of_week)
+        dataset['harvest_fraction'] = harvest_fraction[dataset['day_of_week'].to_numpy()]
         total_before_zeros = len(dataset)
         
         # Supprimer les récoltes à 0 kg en jours ouvrés (Lun-Ven) et samedi
@@ -122,7 +146,9 @@ def create_ml_dataset():
         
         
         # Calculer la production biologique (capacité réelle de tous les plants)
-        dataset['kg_biological'] = np.where(dataset['harvest_fraction'] > 0,dataset['kg_produced'] / dataset['harvest_fraction'],np.nan)
+        kg_produced = dataset['kg_produced'].to_numpy()
+        fraction = dataset['harvest_fraction'].to_numpy()
+        dataset['kg_biological'] = np.divide(kg_produced, fraction, out=np.full_like(kg_produced, np.nan), where=fraction > 0)
         
          # ============================================================
         # ÉTAPE 6 : Filtrer les dimanches (tous)
@@ -156,13 +182,12 @@ def create_ml_dataset():
         # Calculer les moyennes glissantes de la capacité biologique
         print(f"   🌱 Calcul des tendances de capacité biologique...")
         
-        for variety in dataset['variety'].unique():
-            mask = dataset['variety'] == variety
-            
-            # Moyennes glissantes de la capacité biologique
-            dataset.loc[mask, 'kg_biological_7d_mean'] = dataset.loc[mask, 'kg_biological'].rolling(7, min_periods=1).mean()
-            dataset.loc[mask, 'kg_biological_14d_mean'] = dataset.loc[mask, 'kg_biological'].rolling(14, min_periods=1).mean()
-            dataset.loc[mask, 'kg_biological_prev_day'] = dataset.loc[mask, 'kg_biological'].shift(1)
+        by_variety = dataset.groupby('variety', sort=False)['kg_biological']
+        
+        # Moyennes glissantes de la capacité biologique
+        dataset['kg_biological_7d_mean'] = by_variety.rolling(7, min_periods=1).mean().to_numpy()
+        dataset['kg_biological_14d_mean'] = by_variety.rolling(14, min_periods=1).mean().to_numpy()
+        dataset['kg_biological_prev_day'] = by_variety.shift(1)
         
         print(f"   ✅ Tendances biologiques calculées")
         
@@ -177,22 +202,26 @@ def create_ml_dataset():
         dataset['day_of_year'] = dataset['date'].dt.dayofyear
         
         # Jours depuis le début de la saison (pour chaque variété/année)
-        for variety in dataset['variety'].unique():
-            for year in dataset['year'].unique():
-                mask = (dataset['variety'] == variety) & (dataset['year'] == year)
-                if mask.sum() > 0:
-                    first_date = dataset.loc[mask, 'date'].min()
-                    dataset.loc[mask, 'days_since_season_start'] = (dataset.loc[mask, 'date'] - first_date).dt.days
+        first_date = dataset.groupby(['variety', 'year'])['date'].transform('min')
+        dataset['days_since_season_start'] = (dataset['date'] - first_date).dt.days
         
+        # Évaluées en une passe par numexpr (moteur de DataFrame.eval)
         # Delta de température (changement par rapport à la moyenne 7j)
-        dataset['temp_delta'] = dataset['temperature_mean'] - dataset['temp_mean_7d']
+        dataset['temp_delta'] = dataset.eval('temperature_mean - temp_mean_7d', engine='numexpr')
         
         # Production par plant (rendement)
-        dataset['kg_per_plant'] = dataset['kg_produced'] / (dataset['plants_nbrs'] + 1)
+        dataset['kg_per_plant'] = dataset.eval('kg_produced / (plants_nbrs + 1)', engine='numexpr')
         
         print(f"   ✅ Features temporelles créées")
         #Enlever les lignes avec des valeurs manquantes
-        dataset_clean = dataset.dropna()    
+        # Seules la météo (jointure gauche), les moyennes glissantes et les
+        # valeurs décalées peuvent être vides : inutile de scanner les autres colonnes
+        nullable_columns = (
+            list(weather_df.columns)
+            + list(rolling_features)
+            + ['kg_produced_prev_day', 'kg_biological_prev_day', 'temp_delta']
+        )
+        dataset_clean = dataset.dropna(subset=nullable_columns)
         output_path = '/app/data/ml_dataset_simplified.csv'
         dataset_clean.to_csv(output_path, index=False)
         
@@ -200,52 +229,65 @@ def create_ml_dataset():
         print(f"   📊 {len(dataset_clean)} lignes (après nettoyage)")
         print(f"   📋 {len(dataset_clean.columns)} colonnes")
         
-        print("\n" + "="*70)
-        print("📊 FEATURES DU DATASET")
-        print("="*70)
-        print("\n🌱 Features de base :")
-        print("  • date, day_number, plants_nbrs, kg_produced, year, variety")
-        print("  • harvest_fraction (1/3 ou 1/2 selon le jour)")
-        print("  • kg_biological (capacité biologique = target principal)")
-        
-        print("\n🌤️  Features météo instantanées :")
-        print("  • temperature_mean, temperature_min, temperature_max")
-        print("  • humidity_mean, humidity_min, humidity_max")
-        print("  • precipitation, sunshine_duration, solar_radiation")
-        
-        print("\n📈 Features moyennes glissantes (7 jours) :")
-        print("  • temp_mean_7d, humidity_mean_7d")
-        print("  • precipitation_7d_sum, sunshine_7d_sum, solar_radiation_7d_mean")
-        print("  • kg_produced_7d_mean, kg_produced_7d_sum")
-        print("  • kg_produced_prev_day")
-        
-        print("\n🌱 Features capacité biologique :")
-        print("  • kg_biological_7d_mean (moyenne 7j de capacité)")
-        print("  • kg_biological_14d_mean (moyenne 14j de capacité)")
-        print("  • kg_biological_prev_day (capacité jour précédent)")
-        
-        print("\n🕐 Features temporelles :")
-        print("  • month, day_of_week, week_of_year, day_of_year")
-        print("  • days_since_season_start, temp_delta")
-        
-        print("\n📊 Features calculées :")
-        print("  • kg_per_plant (rendement par plant)")
-        
-        print("="*70 + "\n")
-        
-        # Statistiques par variété
-        print("📊 STATISTIQUES PAR VARIÉTÉ")
-        print("="*70)
-        for variety in sorted(dataset_clean['variety'].unique()):
-            variety_data = dataset_clean[dataset_clean['variety'] == variety]
-            print(f"\n{variety}:")
-            print(f"  • Lignes : {len(variety_data)}")
-            print(f"  • Années : {sorted(variety_data['year'].unique())}")
-            print(f"  • Production moyenne : {variety_data['kg_produced'].mean():.2f} kg/jour")
-            print(f"  • Production totale : {variety_data['kg_produced'].sum():.2f} kg")
-            print(f"  • Rendement moyen : {variety_data['kg_per_plant'].mean():.4f} kg/plant/jour")
-        
-        print("="*70 + "\n")
+        # Rapport final construit en mémoire puis écrit en une fois
+        report = io.StringIO()
+        with redirect_stdout(report):
+            print("\n" + "="*70)
+            print("📊 FEATURES DU DATASET")
+            print("="*70)
+            print("\n🌱 Features de base :")
+            print("  • date, day_number, plants_nbrs, kg_produced, year, variety")
+            print("  • harvest_fraction (1/3 ou 1/2 selon le jour)")
+            print("  • kg_biological (capacité biologique = target principal)")
+            
+            print("\n🌤️  Features météo instantanées :")
+            print("  • temperature_mean, temperature_min, temperature_max")
+            print("  • humidity_mean, humidity_min, humidity_max")
+            print("  • precipitation, sunshine_duration, solar_radiation")
+            
+            print("\n📈 Features moyennes glissantes (7 jours) :")
+            print("  • temp_mean_7d, humidity_mean_7d")
+            print("  • precipitation_7d_sum, sunshine_7d_sum, solar_radiation_7d_mean")
+            print("  • kg_produced_7d_mean, kg_produced_7d_sum")
+            print("  • kg_produced_prev_day")
+            
+            print("\n🌱 Features capacité biologique :")
+            print("  • kg_biological_7d_mean (moyenne 7j de capacité)")
+            print("  • kg_biological_14d_mean (moyenne 14j de capacité)")
+            print("  • kg_biological_prev_day (capacité jour précédent)")
+            
+            print("\n🕐 Features temporelles :")
+            print("  • month, day_of_week, week_of_year, day_of_year")
+            print("  • days_since_season_start, temp_delta")
+            
+            print("\n📊 Features calculées :")
+            print("  • kg_per_plant (rendement par plant)")
+            
+            print("="*70 + "\n")
+            
+            # Statistiques par variété
+            print("📊 STATISTIQUES PAR VARIÉTÉ")
+            print("="*70)
+            # Un seul groupby (trié par variété) au lieu d'un masque par variété
+            clean_by_variety = dataset_clean.groupby('variety')
+            variety_summary = clean_by_variety.agg(
+                rows=('kg_produced', 'size'),
+                kg_mean=('kg_produced', 'mean'),
+                kg_sum=('kg_produced', 'sum'),
+                kg_per_plant_mean=('kg_per_plant', 'mean')
+            )
+            variety_years = clean_by_variety['year'].unique()
+            for stats in variety_summary.itertuples():
+                print(f"\n{stats.Index}:")
+                print(f"  • Lignes : {int(stats.rows)}")
+                print(f"  • Années : {sorted(variety_years[stats.Index])}")
+                print(f"  • Production moyenne : {stats.kg_mean:.2f} kg/jour")
+                print(f"  • Production totale : {stats.kg_sum:.2f} kg")
+                print(f"  • Rendement moyen : {stats.kg_per_plant_mean:.4f} kg/plant/jour")
+            
+            print("="*70 + "\n")
+        sys.stdout.write(report.getvalue())
+        sys.stdout.flush()
         
         return dataset_clean
         
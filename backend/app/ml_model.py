@@ -1,9 +1,82 @@
 import pandas as pd
 import joblib
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+from joblib import Parallel, delayed, parallel_backend
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
+from lightgbm import LGBMRegressor
+from sklearn.base import clone
 from sklearn.model_selection import train_test_split, cross_val_score
 from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error
+from skl2onnx import convert_sklearn, update_registered_converter
+from skl2onnx.common.data_types import FloatTensorType
+from skl2onnx.common.shape_calculator import calculate_linear_regressor_output_shapes
+from onnxmltools.convert.lightgbm.operator_converters.LightGbm import convert_lightgbm
 import numpy as np
+import psutil
+
+MODEL_PATH = '/app/data/strawberry_biological_model.pkl'
+ONNX_MODEL_PATH = '/app/data/strawberry_biological_model.onnx'
+
+# Cœurs physiques (les hyperthreads se partagent le cache, contre-productif pour les arbres)
+N_PHYS = psutil.cpu_count(logical=False) or 1
+
+# Convertisseur LightGBM (onnxmltools) enregistré auprès de skl2onnx
+update_registered_converter(
+    LGBMRegressor, 'LightGbmLGBMRegressor',
+    calculate_linear_regressor_output_shapes, convert_lightgbm
+)
+
+
+def export_onnx(model, n_features: int, path: str = ONNX_MODEL_PATH):
+    """
+    Exporte le modèle en ONNX pour l'inférence (onnxruntime, entrée float32)
+    Retourne le chemin du fichier, ou None si la conversion échoue
+    """
+    try:
+        onx = convert_sklearn(
+            model,
+            initial_types=[('X', FloatTensorType([None, n_features]))],
+            target_opset={'': 15, 'ai.onnx.ml': 3}
+        )
+    except Exception as e:
+        print(f"   ⚠️  Export ONNX impossible ({e}), le modèle joblib sera utilisé")
+        return None
+    
+    with open(path, 'wb') as f:
+        f.write(onx.SerializeToString())
+    
+    return path
+
+
+def _fit_and_eval(name, model, X_train, y_train, X_test, y_test):
+    """
+    Entraîne un modèle candidat et calcule ses métriques (exécuté dans un worker joblib)
+    Retourne (nom, modèle entraîné, métriques)
+    """
+    # Entraîner
+    model.fit(X_train, y_train)
+    
+    # Prédire
+    y_pred = model.predict(X_test)
+    
+    # Métriques
+    mae = mean_absolute_error(y_test, y_pred)
+    rmse = np.sqrt(mean_squared_error(y_test, y_pred))
+    r2 = r2_score(y_test, y_pred)
+    
+    # Erreur relative (en %)
+    mask_non_zero = y_test > 0
+    if mask_non_zero.sum() > 0:
+        mape = np.mean(np.abs((y_test[mask_non_zero] - y_pred[mask_non_zero]) / y_test[mask_non_zero])) * 100
+    else:
+        mape = 0
+    
+    return name, model, {
+        'mae': mae,
+        'rmse': rmse,
+        'r2': r2,
+        'mape': mape
+    }
+
 
 def train_biological_model():
     """
@@ -40,7 +113,8 @@ def train_biological_model():
     print("\n🔧 Étape 2/7 : Préparation des features...")
     
     # Encoder la variété
-    df['variety_encoded'] = pd.Categorical(df['variety']).codes
+    variety_categorical = pd.Categorical(df['variety'])
+    df['variety_encoded'] = variety_categorical.codes
     
     # Sélectionner les features importantes
     feature_columns = [
@@ -104,9 +178,10 @@ def train_biological_model():
     
     print(f"   ✅ {len(feature_columns)} features sélectionnées")
     
-    # Features (X) et cible (y)
-    X = df[feature_columns]
-    y = df['kg_biological']  # ⭐ CIBLE = CAPACITÉ BIOLOGIQUE
+    # Features (X) et cible (y), converties une seule fois en tableaux numpy contigus
+    # (X en float32 : pas de copie/validation répétée dans fit, predict et la CV)
+    X = np.ascontiguousarray(df[feature_columns].to_numpy(dtype=np.float32))
+    y = df['kg_biological'].to_numpy(dtype=np.float64)  # ⭐ CIBLE = CAPACITÉ BIOLOGIQUE
     
     print(f"\n   🎯 TARGET : kg_biological")
     print(f"      Moyenne : {y.mean():.2f} kg")
@@ -120,16 +195,24 @@ def train_biological_model():
     
     # Option 1 : Split temporel (recommandé pour les séries temporelles)
     # Les 80% les plus anciennes pour train, les 20% les plus récentes pour test
-    df_sorted = df.sort_values('date')
-    split_idx = int(len(df_sorted) * 0.8)
+    # (masque sur la date de coupure : pas de tri ni de copie du DataFrame)
+    split_date = df['date'].quantile(0.8)
+    train_mask = (df['date'] <= split_date).to_numpy()
+    
+    # Si ≥ 20% des lignes partagent la dernière date, le quantile vaut le max : test vide
+    # → coupure à l'avant-dernière date pour garder un jeu de test
+    if train_mask.all():
+        unique_dates = np.sort(df['date'].unique())
+        if len(unique_dates) < 2:
+            raise ValueError("❌ Une seule date dans le dataset : impossible de séparer train et test")
+        split_date = pd.Timestamp(unique_dates[-2])
+        train_mask = (df['date'] <= split_date).to_numpy()
     
-    X_train = X.iloc[:split_idx]
-    X_test = X.iloc[split_idx:]
-    y_train = y.iloc[:split_idx]
-    y_test = y.iloc[split_idx:]
+    X_train, X_test = X[train_mask], X[~train_mask]
+    y_train, y_test = y[train_mask], y[~train_mask]
     
-    print(f"   ✅ Train : {len(X_train)} lignes (jusqu'à {df_sorted.iloc[split_idx-1]['date'].date()})")
-    print(f"   ✅ Test  : {len(X_test)} lignes (à partir de {df_sorted.iloc[split_idx]['date'].date()})")
+    print(f"   ✅ Train : {len(X_train)} lignes (jusqu'à {split_date.date()})")
+    print(f"   ✅ Test  : {len(X_test)} lignes (à partir de {df.loc[~train_mask, 'date'].min().date()})")
     
     # Option 2 : Split aléatoire (décommenter si vous préférez)
     # X_train, X_test, y_train, y_test = train_test_split(
@@ -148,13 +231,22 @@ def train_biological_model():
             min_samples_split=5,     # Min échantillons pour split
             min_samples_leaf=2,      # Min échantillons par feuille
             random_state=42,
-            n_jobs=-1                # Utiliser tous les CPU
+            n_jobs=N_PHYS            # Utiliser tous les cœurs physiques
         ),
-        'Gradient Boosting': GradientBoostingRegressor(
+        'LightGBM': LGBMRegressor(
             n_estimators=200,
-            max_depth=8,
+            num_leaves=63,           # Croissance par feuille (histogrammes)
             learning_rate=0.05,
-            min_samples_split=5,
+            min_child_samples=5,
+            random_state=42,
+            n_jobs=N_PHYS,
+            verbose=-1
+        ),
+        'Hist Gradient Boosting': HistGradientBoostingRegressor(
+            max_iter=300,            # Features binnées une fois (uint8)
+            max_leaf_nodes=31,
+            learning_rate=0.05,
+            early_stopping=True,
             random_state=42
         )
     }
@@ -165,47 +257,32 @@ def train_biological_model():
     
     results = {}
     
-    for name, model in models.items():
+    # Les modèles sont entraînés en parallèle : les cœurs physiques sont répartis entre eux
+    n_workers = min(len(models), N_PHYS)
+    jobs_per_model = max(1, N_PHYS // n_workers)
+    for model in models.values():
+        if 'n_jobs' in model.get_params():
+            model.set_params(n_jobs=jobs_per_model)
+    
+    with parallel_backend('loky', inner_max_num_threads=jobs_per_model):
+        fitted = Parallel(n_jobs=n_workers)(
+            delayed(_fit_and_eval)(name, model, X_train, y_train, X_test, y_test)
+            for name, model in models.items()
+        )
+    
+    for name, model, metrics in fitted:
         print(f"\n   🔄 Test de {name}...")
         
-        # Entraîner
-        model.fit(X_train, y_train)
-        
-        # Prédire
-        y_pred = model.predict(X_test)
-        
-        # Métriques
-        mae = mean_absolute_error(y_test, y_pred)
-        rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-        r2 = r2_score(y_test, y_pred)
-        
-        # Erreur relative (en %)
-        mask_non_zero = y_test > 0
-        if mask_non_zero.sum() > 0:
-            mape = np.mean(np.abs((y_test[mask_non_zero] - y_pred[mask_non_zero]) / y_test[mask_non_zero])) * 100
-        else:
-            mape = 0
-        
-        # Cross-validation sur le train
-        cv_scores = cross_val_score(model, X_train, y_train, 
-                                     cv=5, 
-                                     scoring='neg_mean_absolute_error',
-                                     n_jobs=-1)
-        cv_mae = -cv_scores.mean()
-        
-        results[name] = {
-            'mae': mae,
-            'rmse': rmse,
-            'r2': r2,
-            'mape': mape,
-            'cv_mae': cv_mae
-        }
+        results[name] = metrics
+        mae = metrics['mae']
+        rmse = metrics['rmse']
+        r2 = metrics['r2']
+        mape = metrics['mape']
         
         print(f"      MAE  : {mae:.2f} kg")
         print(f"      RMSE : {rmse:.2f} kg")
         print(f"      R²   : {r2:.3f}")
         print(f"      MAPE : {mape:.2f}%")
-        print(f"      CV MAE: {cv_mae:.2f} kg (validation croisée)")
         
         # Garder le meilleur
         if mae < best_score:
@@ -215,6 +292,21 @@ def train_biological_model():
     
     print(f"\n   🏆 Meilleur modèle : {best_name} (MAE: {best_score:.2f} kg)")
     
+    # Cross-validation sur le train, uniquement pour le modèle retenu (la sélection se fait sur le MAE test)
+    # (1 thread par worker : n_jobs du modèle remis à 1, car il prime sur la limite OpenMP/BLAS ; pas de sursouscription)
+    cv_model = clone(best_model)
+    if 'n_jobs' in cv_model.get_params():
+        cv_model.set_params(n_jobs=1)
+    with parallel_backend('loky', inner_max_num_threads=1):
+        cv_scores = cross_val_score(cv_model, X_train, y_train, 
+                                     cv=5, 
+                                     scoring='neg_mean_absolute_error',
+                                     n_jobs=N_PHYS)
+    cv_mae = -cv_scores.mean()
+    results[best_name]['cv_mae'] = cv_mae
+    
+    print(f"      CV MAE: {cv_mae:.2f} kg (validation croisée)")
+    
     # ============================================================
     # ÉTAPE 5 : Analyser le meilleur modèle
     # ============================================================
@@ -230,11 +322,11 @@ def train_biological_model():
         }).sort_values('importance', ascending=False)
         
         print("\n   🔍 Top 15 features les plus importantes :")
-        for idx, row in feature_importance.head(15).iterrows():
-            print(f"      {row['feature']:<35} {row['importance']:.4f}")
+        for feature, importance in feature_importance.head(15).itertuples(index=False, name=None):
+            print(f"      {feature:<35} {importance:.4f}")
     
     # Analyse des erreurs
-    errors = np.abs(y_test.values - y_pred_best)
+    errors = np.abs(y_test - y_pred_best)
     print(f"\n   📊 Analyse des erreurs :")
     print(f"      Erreur moyenne    : {errors.mean():.2f} kg")
     print(f"      Erreur médiane    : {np.median(errors):.2f} kg")
@@ -246,8 +338,8 @@ def train_biological_model():
     # ============================================================
     print(f"\n🔄 Étape 6/7 : Conversion capacité biologique → production réelle...")
     
-    # Récupérer les données de test avec day_of_week
-    test_data = df.iloc[split_idx:].copy()
+    # Récupérer les données de test avec day_of_week (uniquement les colonnes utiles)
+    test_data = df.loc[~train_mask, ['date', 'day_of_week', 'variety', 'kg_biological', 'kg_produced']].reset_index(drop=True)
     test_data['kg_biological_pred'] = y_pred_best
     
     # Mapper day_of_week → harvest_fraction
@@ -279,11 +371,18 @@ def train_biological_model():
     # ============================================================
     print(f"\n💾 Étape 7/7 : Sauvegarde du modèle...")
     
+    # Export ONNX avant le .pkl : le service recharge le modèle quand le .pkl change
+    onnx_path = export_onnx(best_model, len(feature_columns))
+    if onnx_path:
+        print(f"   ✅ Modèle ONNX exporté : {onnx_path}")
+    
     model_data = {
         'model': best_model,
         'model_name': best_name,
         'feature_columns': feature_columns,
-        'variety_mapping': dict(enumerate(df['variety'].unique())),
+        'onnx_path': onnx_path,
+        'variety_mapping': dict(enumerate(variety_categorical.categories)),
+        'variety_mapping_inv': {name: code for code, name in enumerate(variety_categorical.categories)},
         'harvest_fraction_map': harvest_fraction_map,
         'metrics': results[best_name],
         'metrics_observed': {
@@ -295,9 +394,9 @@ def train_biological_model():
         'note': 'Ce modèle prédit kg_biological. Pour obtenir kg_produced, multiplier par harvest_fraction.'
     }
     
-    joblib.dump(model_data, '/app/data/strawberry_biological_model.pkl')
+    joblib.dump(model_data, MODEL_PATH)
     
-    print(f"   ✅ Modèle sauvegardé : /app/data/strawberry_biological_model.pkl")
+    print(f"   ✅ Modèle sauvegardé : {MODEL_PATH}")
     
     # ============================================================
     # EXEMPLES DE PRÉDICTIONS
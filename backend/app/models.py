@@ -1,6 +1,10 @@
-from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, SmallInteger, String, Float, Date, ForeignKey, DateTime, Index, cast, extract, func, literal_column
 from .database import Base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, column_property
+
+def active_until(end_date):
+    """Fin effective d'une configuration (NULL = en cours = 'infinity'), expression de l'index des configs actives"""
+    return func.coalesce(end_date, literal_column("'infinity'::date"))
 
 class Variety(Base):
         __tablename__ = "varieties"
@@ -20,8 +24,19 @@ class HarvestRecord(Base):
     plants_nbrs = Column(Integer, nullable=False)
     kg_produced = Column(Float, nullable=False)
     year = Column(Integer, nullable=False, index=True) # ✅ Déjà là
+    # Jour de semaine calculé par PostgreSQL (0 = Dimanche) : expression SQL, pas de colonne en base
+    # (différée : non sélectionnée au chargement des récoltes)
+    dow = column_property(cast(extract('dow', date), SmallInteger), deferred=True)
     variety_id = Column(Integer, ForeignKey("varieties.id"))
     variety = relationship("Variety", back_populates="harvests")
+    
+    __table_args__ = (
+        # Index partiel sur les récoltes à 0 kg (analyse des zéros suspects)
+        # create_all ne l'ajoute pas à une table existante : CREATE INDEX ix_harvest_records_zero_date ON harvest_records (date DESC) WHERE kg_produced = 0;
+        Index("ix_harvest_records_zero_date", date.desc(), postgresql_where=(kg_produced == 0)),
+        # Historique d'une variété sur une période (variety_id = ... AND date BETWEEN ...)
+        Index("ix_harvest_records_variety_date", variety_id, date),
+    )
         
 class WeatherData(Base):
         __tablename__ = "weather_data"
@@ -44,11 +59,24 @@ class PlantConfiguration(Base):
         id = Column(Integer, primary_key=True, index=True)
         variety_id = Column(Integer, ForeignKey("varieties.id"), nullable=False)
         start_date = Column(Date, nullable=False, index=True)
-        end_date = Column(Date, nullable=True, index=True)  # NULL = config actuelle
+        end_date = Column(Date, nullable=True)  # NULL = config actuelle
         plants_nbrs = Column(Integer, nullable=False)
         # Relations
         variety = relationship("Variety")
         
+        __table_args__ = (
+            # Liste des configs par variété, la plus récente d'abord
+            Index("ix_plant_configurations_variety_start_date", variety_id, start_date.desc()),
+            # Configs actives : une seule borne sur active_until(end_date) au lieu d'un OR
+            # (pas d'index partiel : CURRENT_DATE est interdit dans le prédicat d'un index),
+            # index couvrant pour un parcours d'index seul
+            Index(
+                "ix_plant_configurations_active",
+                active_until(end_date), start_date,
+                postgresql_include=["end_date", "variety_id", "plants_nbrs", "id"]
+            ),
+        )
+        
 class Prediction(Base):                    # ← NOUVEAU
     __tablename__ = "predictions"
     
@@ -62,4 +90,9 @@ class Prediction(Base):                    # ← NOUVEAU
     harvest_fraction = Column(Float, nullable=False)
     
     variety = relationship("Variety")
+    
+    __table_args__ = (
+        # Dernière prédiction par (variété, jour) : /predictions/latest
+        Index("ix_predictions_variety_target_prediction_date", variety_id, target_date, prediction_date.desc()),
+    )
     
\ No newline at end of file
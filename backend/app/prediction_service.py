@@ -1,11 +1,70 @@
 import joblib
 import pandas as pd
 import requests
+import orjson
 from datetime import datetime, timedelta, date
 from sqlalchemy.orm import Session
-from .models import Prediction, Variety, PlantConfiguration, HarvestRecord, WeatherData
+from .models import Prediction, Variety, PlantConfiguration, HarvestRecord, WeatherData, active_until
 from .database import SessionLocal
 import sys
+import os
+import numpy as np
+import onnxruntime as ort
+
+MODEL_PATH = '/app/data/strawberry_biological_model.pkl'
+
+# Fraction de plants récoltés par jour de semaine (0=Lundi ... 6=Dimanche)
+# Dimanche à 1 : pas de récolte, la production historique est prise telle quelle
+HARVEST_FRACTION_ARR = np.array([1/3, 1/3, 1/3, 1/2, 1/2, 1/2, 1.0])
+
+_MODEL_CACHE = {'path': None, 'mtime': 0, 'data': None}
+
+# Session HTTP partagée : connexion TCP/TLS réutilisée entre les appels Open-Meteo
+HTTP_TIMEOUT = 5
+_HTTP = requests.Session()
+_HTTP.headers.update({'User-Agent': 'strawberry-predictor'})
+
+
+def _get_model(path: str = MODEL_PATH):
+    """
+    Charge le modèle une seule fois par processus
+    Rechargé uniquement si le fichier a changé (ré-entraînement)
+    """
+    mtime = os.path.getmtime(path)
+    if _MODEL_CACHE['data'] is None or _MODEL_CACHE['path'] != path or _MODEL_CACHE['mtime'] != mtime:
+        model_data = joblib.load(path)
+        
+        # Session ONNX si le modèle a été exporté (anciens modèles : predict sklearn)
+        onnx_path = model_data.get('onnx_path')
+        model_data['onnx_session'] = None
+        if onnx_path and os.path.exists(onnx_path):
+            model_data['onnx_session'] = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+        
+        _MODEL_CACHE['data'] = model_data
+        _MODEL_CACHE['path'] = path
+        _MODEL_CACHE['mtime'] = mtime
+    return _MODEL_CACHE['data']
+
+
+def _predict(model_data: dict, features_df: pd.DataFrame):
+    """
+    Prédit kg_biological via onnxruntime si disponible, sinon via le modèle sklearn
+    """
+    # Matrice float32 contiguë : évite la conversion/copie à chaque traversée d'arbres
+    features_df = features_df.astype(np.float32, copy=False)
+    
+    session = model_data.get('onnx_session')
+    if session is not None:
+        X = np.ascontiguousarray(features_df.to_numpy())
+        return session.run(None, {session.get_inputs()[0].name: X})[0].ravel()
+    
+    # Modèles entraînés sur tableau numpy : pas de noms de colonnes à fournir
+    model = model_data['model']
+    if not hasattr(model, 'feature_names_in_'):
+        return model.predict(np.ascontiguousarray(features_df.to_numpy()))
+    
+    return model.predict(features_df)
+
 
 def get_weather_forecast(latitude: float = 43.1397, longitude: float = 6.1556, days: int = 7,test_date: date = None):
     """
@@ -71,8 +130,8 @@ def get_weather_forecast(latitude: float = 43.1397, longitude: float = 6.1556, d
             "timezone": "Europe/Paris"
         }
     
-    response = requests.get(url, params=params)
-    data = response.json()
+    response = _HTTP.get(url, params=params, timeout=HTTP_TIMEOUT)
+    data = orjson.loads(response.content)
     
     # Convertir en DataFrame
     df = pd.DataFrame({
@@ -82,7 +141,7 @@ def get_weather_forecast(latitude: float = 43.1397, longitude: float = 6.1556, d
         'temperature_mean': data['daily']['temperature_2m_mean'],
         'humidity_mean': data['daily']['relative_humidity_2m_mean'],
         'precipitation': data['daily']['precipitation_sum'],
-        'sunshine_duration': [h / 3600 if h else 0 for h in data['daily']['sunshine_duration']],
+        'sunshine_duration': np.nan_to_num(np.array(data['daily']['sunshine_duration'], dtype=float)) / 3600,  # secondes → heures (None → 0)
         'solar_radiation': data['daily']['shortwave_radiation_sum']
     })
     
@@ -96,40 +155,101 @@ def get_current_plant_config(db: Session, variety_id: int, target_date: date):
     config = db.query(PlantConfiguration).filter(
         PlantConfiguration.variety_id == variety_id,
         PlantConfiguration.start_date <= target_date,
-        (PlantConfiguration.end_date.is_(None)) | (PlantConfiguration.end_date >= target_date)
+        active_until(PlantConfiguration.end_date) >= target_date
     ).first()
     
     return config.plants_nbrs if config else 0
 
 
-def calculate_features(
+WEATHER_HIST_COLUMNS = ['temperature_mean', 'humidity_mean', 'precipitation', 'sunshine_duration', 'solar_radiation']
+
+
+def _harvest_arrays(dates, kg_produced):
+    """
+    Convertit un historique de récoltes en tableaux numpy (dates, kg_biological)
+    """
+    dates = pd.to_datetime(pd.Series(dates, dtype=object))
+    kg_biological = np.asarray(kg_produced, dtype=float) / HARVEST_FRACTION_ARR[dates.dt.weekday.to_numpy()]
+    return dates.to_numpy(dtype='datetime64[D]'), kg_biological
+
+
+def _window(dates: np.ndarray, start: date, end: date):
+    """
+    Bornes [lo, hi) des dates comprises entre start et end (tableau trié)
+    """
+    lo = np.searchsorted(dates, np.datetime64(start, 'D'), side='left')
+    hi = np.searchsorted(dates, np.datetime64(end, 'D'), side='right')
+    return lo, hi
+
+
+def load_history(db: Session, start_date: date, end_date: date):
+    """
+    Récupère en une fois l'historique récoltes (toutes variétés) et météo sur une période
+    Retourne, en tableaux numpy triés par date :
+    - par variety_id : (dates, kg_biological)
+    - météo : (dates, valeurs WEATHER_HIST_COLUMNS)
+    Chaque fenêtre de 14 jours est ensuite un simple découpage de ces tableaux
+    """
+    harvests = db.query(HarvestRecord.variety_id, HarvestRecord.date, HarvestRecord.kg_produced).filter(
+        HarvestRecord.date >= start_date,
+        HarvestRecord.date <= end_date
+    ).order_by(HarvestRecord.date).all()
+    
+    harvests_df = pd.DataFrame(harvests, columns=['variety_id', 'date', 'kg_produced'])
+    harvests_by_variety = {
+        variety_id: _harvest_arrays(group['date'], group['kg_produced'])
+        for variety_id, group in harvests_df.groupby('variety_id', sort=False)
+    }
+    
+    weather = db.query(
+        WeatherData.date,
+        WeatherData.temperature_mean,
+        WeatherData.humidity_mean,
+        WeatherData.precipitation,
+        WeatherData.sunshine_duration,
+        WeatherData.solar_radiation
+    ).filter(
+        WeatherData.date >= start_date,
+        WeatherData.date <= end_date
+    ).order_by(WeatherData.date).all()
+    
+    weather_df = pd.DataFrame(weather, columns=['date'] + WEATHER_HIST_COLUMNS)
+    weather_history = (
+        pd.to_datetime(weather_df['date']).to_numpy(dtype='datetime64[D]'),
+        weather_df[WEATHER_HIST_COLUMNS].to_numpy(dtype=float)
+    )
+    
+    return harvests_by_variety, weather_history
+
+
+def _history_stats(
     db: Session,
     variety_id: int,
     variety_name: str,
-    plants_nbrs: int,
     target_date: date,
-    weather_forecast: dict,
-    model_data: dict
+    harvest_history: tuple,
+    weather_history: tuple
 ):
     """
-    Calcule les 27 features nécessaires pour la prédiction
+    Agrégats de l'historique des 14 jours précédant target_date
+    Retourne (kg_biological_prev, 7j, 14j, temp_mean_7d, humidity_mean_7d, precipitation_7d_sum, sunshine_7d_sum, solar_radiation_7d_mean)
     """
-    # Récupérer historique des 14 derniers jours
+    # Historique des 14 derniers jours (découpage des tableaux préchargés)
     start_hist = target_date - timedelta(days=14)
     end_hist = target_date - timedelta(days=1)
     
-    recent_harvests = db.query(HarvestRecord).filter(
-        HarvestRecord.variety_id == variety_id,
-        HarvestRecord.date >= start_hist,
-        HarvestRecord.date <= end_hist
-    ).order_by(HarvestRecord.date).all()
+    kgb = np.empty(0)
+    if harvest_history is not None:
+        hist_dates, hist_kgb = harvest_history
+        lo, hi = _window(hist_dates, start_hist, end_hist)
+        kgb = hist_kgb[lo:hi]
    
-    if not recent_harvests:
-        print(f"   ⚠️  Pas assez d'historique récent ({len(recent_harvests) if recent_harvests else 0} jours)")
+    if len(kgb) == 0:
+        print(f"   ⚠️  Pas assez d'historique récent (0 jours)")
         print(f"   🔄 Utilisation de la même période année {target_date.year - 1}...")
         start_hist_prev = start_hist.replace(year=start_hist.year - 1)
         end_hist_prev = end_hist.replace(year=end_hist.year - 1)
-        recent_harvests = db.query(HarvestRecord).filter(
+        recent_harvests = db.query(HarvestRecord.date, HarvestRecord.kg_produced).filter(
             HarvestRecord.variety_id == variety_id,
             HarvestRecord.date >= start_hist_prev,
             HarvestRecord.date <= end_hist_prev
@@ -139,91 +259,92 @@ def calculate_features(
             print(f"   ❌ Aucune donnée disponible pour {variety_name}, skip")
             sys.exit()
         
+        # Calculer kg_biological depuis historique
+        _, kgb = _harvest_arrays(*zip(*recent_harvests))
     
-    
-    # Convertir en DataFrame
-    hist_df = pd.DataFrame([{
-        'date': h.date,
-        'kg_produced': h.kg_produced,
-        'day_of_week': h.date.weekday()
-    } for h in recent_harvests])
-    
-    # Calculer kg_biological depuis historique
-    harvest_fraction_map = {0: 1/3, 1: 1/3, 2: 1/3, 3: 1/2, 4: 1/2, 5: 1/2, 6: 0}
-    hist_df['harvest_fraction'] = hist_df['day_of_week'].map(harvest_fraction_map)
-    hist_df['kg_biological'] = hist_df['kg_produced'] / hist_df['harvest_fraction'].replace(0, 1)
-    
-    # Récupérer météo historique
-    weather_hist = db.query(WeatherData).filter(
-        WeatherData.date >= start_hist,
-        WeatherData.date <= end_hist
-    ).order_by(WeatherData.date).all()
-    
-    weather_df = pd.DataFrame([{
-        'date': w.date,
-        'temperature_mean': w.temperature_mean,
-        'humidity_mean': w.humidity_mean,
-        'precipitation': w.precipitation,
-        'sunshine_duration': w.sunshine_duration,
-        'solar_radiation': w.solar_radiation
-    } for w in weather_hist])
+    # Météo historique
+    weather_dates, weather_values = weather_history
+    lo, hi = _window(weather_dates, start_hist, end_hist)
    
-    # Calculer moyennes 7j et 14j
-    kg_biological_7d = hist_df.tail(7)['kg_biological'].mean()
-    kg_biological_14d = hist_df['kg_biological'].mean()
-    kg_biological_prev = hist_df.iloc[-1]['kg_biological'] if len(hist_df) > 0 else 0
-    
-    temp_mean_7d = weather_df.tail(7)['temperature_mean'].mean()
-    humidity_mean_7d = weather_df.tail(7)['humidity_mean'].mean()
-    precipitation_7d_sum = weather_df.tail(7)['precipitation'].sum()
-    sunshine_7d_sum = weather_df.tail(7)['sunshine_duration'].sum()
-    solar_radiation_7d_mean = weather_df.tail(7)['solar_radiation'].mean()
-    
-    # Features temporelles
-    month = target_date.month
-    week_of_year = target_date.isocalendar()[1]
-    day_of_year = target_date.timetuple().tm_yday
-    day_of_week = target_date.weekday()
-    # Days since season start (approximation : depuis le 1er janvier de l'année)
-    season_start = date(target_date.year, 1, 1)
-    days_since_season_start = (target_date - season_start).days
+    # Calculer moyennes 7j et 14j (tableaux numpy, NaN ignorés comme en pandas)
+    kg_biological_7d = np.nanmean(kgb[-7:])
+    kg_biological_14d = np.nanmean(kgb)
+    kg_biological_prev = kgb[-1] if len(kgb) > 0 else 0
     
-    # Température delta
-    temp_delta = weather_forecast['temperature_mean'] - temp_mean_7d
+    weather_arr = weather_values[lo:hi][-7:]
+    temp_mean_7d, humidity_mean_7d, _, _, solar_radiation_7d_mean = np.nanmean(weather_arr, axis=0)
+    _, _, precipitation_7d_sum, sunshine_7d_sum, _ = np.nansum(weather_arr, axis=0)
     
-    # Rendement
-    kg_per_plant = kg_biological_prev / plants_nbrs if plants_nbrs > 0 else 0
+    return (
+        kg_biological_prev, kg_biological_7d, kg_biological_14d,
+        temp_mean_7d, humidity_mean_7d, precipitation_7d_sum, sunshine_7d_sum, solar_radiation_7d_mean
+    )
+
+
+def calculate_features(
+    db: Session,
+    variety_id: int,
+    variety_name: str,
+    plants_nbrs: list,
+    target_dates: list,
+    weather_forecast: pd.DataFrame,
+    model_data: dict,
+    harvest_history: tuple,
+    weather_history: tuple
+):
+    """
+    Calcule les 27 features nécessaires pour la prédiction, pour tous les jours d'une variété
+    Retourne un DataFrame (une ligne par target_date)
+    plants_nbrs / weather_forecast : alignés sur target_dates
+    harvest_history / weather_history : tableaux préchargés par load_history
+    """
+    # Agrégats historiques (fenêtre de 14 jours propre à chaque jour)
+    stats = np.array([
+        _history_stats(db, variety_id, variety_name, target_date, harvest_history, weather_history)
+        for target_date in target_dates
+    ], dtype=float).reshape(-1, 8)
     
-    # Encoder variety
-    variety_mapping = model_data.get('variety_mapping', {})
-    variety_encoded = [k for k, v in variety_mapping.items() if v == variety_name]
-    variety_encoded = variety_encoded[0] if variety_encoded else 0
+    # Encoder variety (mapping inverse nom → code, reconstruit pour les anciens modèles)
+    variety_mapping_inv = model_data.get('variety_mapping_inv')
+    if variety_mapping_inv is None:
+        variety_mapping_inv = {v: k for k, v in model_data.get('variety_mapping', {}).items()}
+        model_data['variety_mapping_inv'] = variety_mapping_inv
+    variety_encoded = variety_mapping_inv.get(variety_name, 0)
     
-    # Créer le vecteur de features
-    features = {
+    dates = pd.to_datetime(pd.Series(target_dates, dtype=object))
+    plants = np.asarray(plants_nbrs, dtype=float)
+    
+    features = pd.DataFrame({
         'variety_encoded': variety_encoded,
         'plants_nbrs': plants_nbrs,
-        'month': month,
-        'week_of_year': week_of_year,
-        'day_of_year': day_of_year,
-        'day_of_week': day_of_week,
-        'days_since_season_start': days_since_season_start,
-        'temperature_mean': weather_forecast['temperature_mean'],
-        'humidity_mean': weather_forecast['humidity_mean'],
-        'precipitation': weather_forecast['precipitation'],
-        'sunshine_duration': weather_forecast['sunshine_duration'],
-        'solar_radiation': weather_forecast['solar_radiation'],
-        'temp_mean_7d': temp_mean_7d,
-        'humidity_mean_7d': humidity_mean_7d,
-        'precipitation_7d_sum': precipitation_7d_sum,
-        'sunshine_7d_sum': sunshine_7d_sum,
-        'solar_radiation_7d_mean': solar_radiation_7d_mean,
-        'temp_delta': temp_delta,
-        'kg_biological_prev_day': kg_biological_prev,
-        'kg_biological_7d_mean': kg_biological_7d,
-        'kg_biological_14d_mean': kg_biological_14d,
-        'kg_per_plant': kg_per_plant
-    }
+        # Features temporelles
+        'month': dates.dt.month,
+        'week_of_year': dates.dt.isocalendar().week.astype(int),
+        'day_of_year': dates.dt.dayofyear,
+        'day_of_week': dates.dt.weekday,
+        # Days since season start (approximation : depuis le 1er janvier de l'année)
+        'days_since_season_start': dates.dt.dayofyear - 1,
+    })
+    
+    # Prévisions météo du jour
+    for column in WEATHER_HIST_COLUMNS:
+        features[column] = weather_forecast[column].to_numpy()
+    
+    features['temp_mean_7d'] = stats[:, 3]
+    features['humidity_mean_7d'] = stats[:, 4]
+    features['precipitation_7d_sum'] = stats[:, 5]
+    features['sunshine_7d_sum'] = stats[:, 6]
+    features['solar_radiation_7d_mean'] = stats[:, 7]
+    
+    # Température delta
+    features['temp_delta'] = features['temperature_mean'].to_numpy() - stats[:, 3]
+    
+    features['kg_biological_prev_day'] = stats[:, 0]
+    features['kg_biological_7d_mean'] = stats[:, 1]
+    features['kg_biological_14d_mean'] = stats[:, 2]
+    
+    # Rendement
+    features['kg_per_plant'] = np.divide(stats[:, 0], plants, out=np.zeros(len(plants)), where=plants > 0)
 
     return features
 
@@ -243,10 +364,8 @@ def generate_predictions(days: int = 7):
     try:
         # Charger le modèle
         print("📦 Chargement du modèle...")
-        model_data = joblib.load('/app/data/strawberry_biological_model.pkl')
-        model = model_data['model']
+        model_data = _get_model()
         feature_columns = model_data['feature_columns']
-        harvest_fraction_map = model_data['harvest_fraction_map']
         
         print("✅ Modèle chargé\n")
         
@@ -263,10 +382,26 @@ def generate_predictions(days: int = 7):
             print(f"🧪 MODE TEST : Date de référence = {today}\n")
         total_predictions = 0
         
+        # Historique récoltes + météo chargé une seule fois pour toutes les variétés et tous les jours
+        harvests_by_variety, weather_history = load_history(
+            db,
+            today + timedelta(days=1) - timedelta(days=14),
+            today + timedelta(days=days) - timedelta(days=1)
+        )
+        
+        # Features (un DataFrame par variété) et métadonnées, prédites en un seul appel
+        feature_frames = []
+        meta = []
+        
         # Pour chaque variété
         for variety in varieties:
             print(f"📊 {variety.name}:")
             
+            # Jours à prédire pour cette variété
+            target_dates = []
+            plants_list = []
+            forecast_positions = []
+            
             # Pour chaque jour
             for day_offset in range(1, days + 1):
                 target_date = today + timedelta(days=day_offset)
@@ -282,53 +417,59 @@ def generate_predictions(days: int = 7):
                     print(f"   ⚠️  Pas de config plants pour {target_date}, skip")
                     continue
                 
-                # Récupérer prévision météo du jour
-                weather_row = weather_forecasts.iloc[day_offset - 1]
-                weather_dict = {
-                    'temperature_mean': weather_row['temperature_mean'],
-                    'humidity_mean': weather_row['humidity_mean'],
-                    'precipitation': weather_row['precipitation'],
-                    'sunshine_duration': weather_row['sunshine_duration'],
-                    'solar_radiation': weather_row['solar_radiation']
-                }
-                
-                # Calculer features
-                features_dict = calculate_features(
-                    db, variety.id, variety.name, plants_nbrs,
-                    target_date, weather_dict, model_data
+                target_dates.append(target_date)
+                plants_list.append(plants_nbrs)
+                # Prévision météo du jour
+                forecast_positions.append(day_offset - 1)
+            
+            if target_dates:
+                # Calculer features de tous les jours en une passe
+                feature_frames.append(calculate_features(
+                    db, variety.id, variety.name, plants_list,
+                    target_dates, weather_forecasts.iloc[forecast_positions], model_data,
+                    harvests_by_variety.get(variety.id), weather_history
+                ))
+                meta.extend(
+                    (variety.name, variety.id, target_date, plants_nbrs)
+                    for target_date, plants_nbrs in zip(target_dates, plants_list)
                 )
-                
-                if not features_dict:
-                    continue
-                
-                # Créer DataFrame dans l'ordre des features
-                features_df = pd.DataFrame([features_dict])
-                features_df = features_df[feature_columns]
-                
-                # Prédire
-                kg_biological_pred = model.predict(features_df)[0]
-                
+            
+            print()
+        
+        predictions = []
+        
+        if feature_frames:
+            # Créer DataFrame dans l'ordre des features
+            features_df = pd.concat(feature_frames, ignore_index=True)[feature_columns]
+            
+            # Prédire (un seul appel pour toutes les variétés et tous les jours)
+            kg_biological_preds = _predict(model_data, features_df)
+            
+            prediction_date = datetime.now()
+            
+            for (variety_name, variety_id, target_date, plants_nbrs), kg_biological_pred in zip(meta, kg_biological_preds):
                 # Convertir en production observée
-                harvest_fraction = harvest_fraction_map.get(target_date.weekday(), 0)
+                harvest_fraction = float(HARVEST_FRACTION_ARR[target_date.weekday()])
                 kg_produced_pred = kg_biological_pred * harvest_fraction
                 
                 # Stocker en DB
-                prediction = Prediction(
-                    prediction_date=datetime.now(),
-                    target_date=target_date,
-                    variety_id=variety.id,
-                    plants_nbrs=plants_nbrs,
-                    kg_biological_predicted=round(kg_biological_pred, 2),
-                    kg_produced_predicted=round(kg_produced_pred, 2),
-                    harvest_fraction=harvest_fraction
-                )
-                db.add(prediction)
+                predictions.append({
+                    "prediction_date": prediction_date,
+                    "target_date": target_date,
+                    "variety_id": variety_id,
+                    "plants_nbrs": plants_nbrs,
+                    "kg_biological_predicted": round(float(kg_biological_pred), 2),
+                    "kg_produced_predicted": round(float(kg_produced_pred), 2),
+                    "harvest_fraction": harvest_fraction
+                })
                 total_predictions += 1
                 
-                print(f"   ✅ {target_date} : {kg_biological_pred:.1f} kg bio → {kg_produced_pred:.1f} kg prod")
+                print(f"   ✅ {variety_name} {target_date} : {kg_biological_pred:.1f} kg bio → {kg_produced_pred:.1f} kg prod")
             
             print()
         
+        # Insertion groupée, sans créer d'objets ORM
+        db.bulk_insert_mappings(Prediction, predictions)
         db.commit()
         
         print("="*70)
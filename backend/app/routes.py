@@ -1,10 +1,16 @@
 from fastapi import APIRouter, Depends,HTTPException, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func, extract
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy import select, func, tuple_, cast, Numeric, Float, lambda_stmt
+from sqlalchemy.exc import IntegrityError
 from typing import List, Optional
 from datetime import date, datetime  
-from .database import get_db
-from .models import Variety, HarvestRecord, PlantConfiguration,Prediction    
+from fastapi_cache.decorator import cache
+import orjson
+from .database import get_db, AsyncSessionLocal
+from .cache import STATS_NAMESPACE, STATS_EXPIRE, VARIETIES_NAMESPACE, VARIETIES_EXPIRE, query_key_builder
+from .models import Variety, HarvestRecord, PlantConfiguration,Prediction, active_until    
 from .schemas import(
     VarietyResponse,
     HarvestRecordResponse,
@@ -18,116 +24,190 @@ from .schemas import(
 router = APIRouter(prefix="/api", tags=["API"])
 
 
+def year_range(year: int):
+    """
+    Bornes [1er janvier, 1er janvier suivant) d'une année
+    Filtre sur intervalle : utilise les index sur date (extract('year', ...) ne le permet pas)
+    """
+    return date(year, 1, 1), date(year + 1, 1, 1)
+
+# Note : en AsyncSession les relations ne peuvent pas être chargées à la volée,
+# `variety` est donc chargée explicitement pour les réponses imbriquées (pas de N+1) :
+# - joinedload : relation many-to-one, une seule requête avec JOIN
+# - listes de récoltes : colonnes sélectionnées avec JOIN, réponse construite sans objets ORM
+
 
 @router.get("/varieties", response_model=List[VarietyResponse])
-def get_varieties(db:Session = Depends(get_db)):
+@cache(expire=VARIETIES_EXPIRE, namespace=VARIETIES_NAMESPACE, key_builder=query_key_builder)
+async def get_varieties(db: AsyncSession = Depends(get_db)):
     """Get all varieties"""
-    varieties = db.query(Variety).all()
+    result = await db.execute(select(Variety))
+    # Schémas Pydantic (et non objets ORM) pour pouvoir être sérialisés dans le cache
+    varieties = [VarietyResponse.model_validate(v) for v in result.scalars()]
     return varieties
 
 @router.get("/varieties/{variety_id}", response_model=VarietyResponse)
-def get_variety(variety_id: int, db: Session = Depends(get_db)):
+@cache(expire=VARIETIES_EXPIRE, namespace=VARIETIES_NAMESPACE, key_builder=query_key_builder)
+async def get_variety(variety_id: int, db: AsyncSession = Depends(get_db)):
     """Récupère une variété par son ID"""
-    variety = db.query(Variety).filter(Variety.id == variety_id).first()
+    variety = await db.get(Variety, variety_id)
     if not variety:
         raise HTTPException(status_code=404, detail="Variété not found")
-    return variety
+    return VarietyResponse.model_validate(variety)
 
-@router.get("/harvests", response_model=List[HarvestRecordResponse])
-def get_harvests(
-    variety_id: Optional[int] = Query(None, description="Filtrer par variété"),
-    year: Optional[int] = Query(None, description="Filtrer par année"),
-    start_date: Optional[date] = Query(None, description="Date de début"),
-    end_date: Optional[date] = Query(None, description="Date de fin"),
-    limit: int = Query(100, description="Nombre maximum de résultats"),
-    db: Session = Depends(get_db)
-):
-    """Récupère les enregistrements de récolte avec filtres optionnels"""
-    query = db.query(HarvestRecord)
-    
-    # Filtres
+def harvest_rows_stmt():
+    """
+    Colonnes récolte + variété (une ligne par récolte)
+    lambda_stmt : SQL compilé mis en cache, les valeurs des filtres deviennent des paramètres liés
+    """
+    return lambda_stmt(lambda: select(
+        HarvestRecord.id,
+        HarvestRecord.date,
+        HarvestRecord.plants_nbrs,
+        HarvestRecord.kg_produced,
+        HarvestRecord.variety_id,
+        Variety.name,
+        Variety.description
+    ).join(Variety))
+
+def filter_harvests(query, variety_id, year, start_date, end_date):
+    """Filtres optionnels communs aux routes de récoltes (et tri par date décroissante)"""
     if variety_id:
-        query = query.filter(HarvestRecord.variety_id == variety_id)
+        query += lambda s: s.where(HarvestRecord.variety_id == variety_id)
     
     if year:
-        query = query.filter(extract('year', HarvestRecord.date) == year)
+        year_start, year_end = year_range(year)
+        query += lambda s: s.where(HarvestRecord.date >= year_start, HarvestRecord.date < year_end)
     
     if start_date:
-        query = query.filter(HarvestRecord.date >= start_date)
+        query += lambda s: s.where(HarvestRecord.date >= start_date)
     
     if end_date:
-        query = query.filter(HarvestRecord.date <= end_date)
+        query += lambda s: s.where(HarvestRecord.date <= end_date)
     
     # Tri par date décroissante
-    query = query.order_by(HarvestRecord.date.desc())
+    query += lambda s: s.order_by(HarvestRecord.date.desc())
+    
+    return query
+
+def harvest_row(r) -> dict:
+    """Ligne (récolte + variété) au format HarvestRecordResponse"""
+    return {
+        "date": r.date,
+        "plants_nbrs": r.plants_nbrs,
+        "kg_produced": r.kg_produced,
+        "id": r.id,
+        "variety_id": r.variety_id,
+        "variety": {"name": r.name, "description": r.description, "id": r.variety_id}
+    }
+
+# Schéma conservé pour l'OpenAPI uniquement : la réponse est construite directement (sans Pydantic par ligne)
+@router.get("/harvests", response_model=None, responses={200: {"model": List[HarvestRecordResponse]}})
+async def get_harvests(
+    variety_id: Optional[int] = Query(None, description="Filtrer par variété"),
+    year: Optional[int] = Query(None, description="Filtrer par année"),
+    start_date: Optional[date] = Query(None, description="Date de début"),
+    end_date: Optional[date] = Query(None, description="Date de fin"),
+    limit: int = Query(100, description="Nombre maximum de résultats"),
+    db: AsyncSession = Depends(get_db)
+):
+    """Récupère les enregistrements de récolte avec filtres optionnels"""
+    query = filter_harvests(harvest_rows_stmt(), variety_id, year, start_date, end_date)
     
     # Limite
-    harvests = query.limit(limit).all()
+    query += lambda s: s.limit(limit)
+    result = await db.execute(query)
     
-    return harvests
+    return ORJSONResponse([harvest_row(r) for r in result])
 
 @router.get("/harvests/{harvest_id}", response_model=HarvestRecordResponse)
-def get_harvest(harvest_id: int, db: Session = Depends(get_db)):
+async def get_harvest(harvest_id: int, db: AsyncSession = Depends(get_db)):
     """Récupère un enregistrement de récolte par son ID"""
-    harvest = db.query(HarvestRecord).filter(HarvestRecord.id == harvest_id).first()
+    harvest = await db.get(HarvestRecord, harvest_id, options=[joinedload(HarvestRecord.variety)])
     if not harvest:
         raise HTTPException(status_code=404, detail="Enregistrement non trouvé")
     return harvest
 
+@router.get("/harvests.ndjson")
+async def export_harvests(
+    variety_id: Optional[int] = Query(None, description="Filtrer par variété"),
+    year: Optional[int] = Query(None, description="Filtrer par année"),
+    start_date: Optional[date] = Query(None, description="Date de début"),
+    end_date: Optional[date] = Query(None, description="Date de fin")
+):
+    """
+    Export des récoltes en NDJSON (une ligne JSON par enregistrement), sans limite
+    Curseur serveur + lots de 500 lignes : la mémoire ne dépend pas du volume exporté
+    """
+    query = filter_harvests(harvest_rows_stmt(), variety_id, year, start_date, end_date)
+    
+    async def generate():
+        # Session propre au flux : celle de get_db est fermée avant l'envoi du corps
+        async with AsyncSessionLocal() as db:
+            # yield_per passé à l'exécution (un lambda_stmt copié par execution_options() perd ses paramètres)
+            result = await db.stream(query, execution_options={"yield_per": 500})
+            async for r in result:
+                yield orjson.dumps(harvest_row(r)) + b"\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 
 # ============================================================
 # ROUTES STATISTIQUES
 # ============================================================
 
+def sql_round(expr, digits: int = 3):
+    """
+    ROUND(COALESCE(expr, 0), digits) calculé par PostgreSQL
+    (round(x, n) n'existe qu'en numeric : aller-retour par numeric puis float)
+    """
+    return cast(func.round(cast(func.coalesce(expr, 0), Numeric), digits), Float)
+
 @router.get("/stats/summary")
-def get_stats_summary(
+@cache(expire=STATS_EXPIRE, namespace=STATS_NAMESPACE, key_builder=query_key_builder)
+async def get_stats_summary(
     variety_id: Optional[int] = Query(None, description="Filtrer par variété"),
     year: Optional[int] = Query(None, description="Filtrer par année"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Statistiques globales de production"""
-    query = db.query(
-        func.count(HarvestRecord.id).label('total_records'),
-        func.sum(HarvestRecord.kg_produced).label('total_kg_produced'),
-        func.sum(HarvestRecord.kg_declassified).label('total_kg_declassified'),
-        func.sum(HarvestRecord.kg_loss).label('total_kg_loss'),
-        func.avg(HarvestRecord.kg_produced).label('avg_kg_produced')
+    query = select(
+        func.count().label('total_records'),
+        sql_round(func.sum(HarvestRecord.kg_produced)).label('total_kg_produced'),
+        sql_round(func.avg(HarvestRecord.kg_produced)).label('avg_kg_produced')
     )
     
     if variety_id:
-        query = query.filter(HarvestRecord.variety_id == variety_id)
+        query = query.where(HarvestRecord.variety_id == variety_id)
     
     if year:
-        query = query.filter(extract('year', HarvestRecord.date) == year)
+        year_start, year_end = year_range(year)
+        query = query.where(HarvestRecord.date >= year_start, HarvestRecord.date < year_end)
     
-    result = query.first()
+    result = (await db.execute(query)).first()
     
-    return {
-        "total_records": round(result.total_records or 0,3),
-        "total_kg_produced": round(float(result.total_kg_produced or 0),3),
-        "total_kg_declassified": round(float(result.total_kg_declassified or 0),3),
-        "total_kg_loss": round(float(result.total_kg_loss or 0),3),
-        "avg_kg_produced": round(float(result.avg_kg_produced or 0),3)
-    }
+    return dict(result._mapping)
 
 @router.get("/stats/by-variety")
-def get_stats_by_variety(
+@cache(expire=STATS_EXPIRE, namespace=STATS_NAMESPACE, key_builder=query_key_builder)
+async def get_stats_by_variety(
     year: Optional[int] = Query(None, description="Filtrer par année"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Statistiques par variété"""
-    query = db.query(
+    query = select(
         Variety.name,
         func.sum(HarvestRecord.kg_produced).label('total_kg_produced'),
-        func.count(HarvestRecord.id).label('total_records')
+        func.count().label('total_records')
     ).join(HarvestRecord)
     
     if year:
-        query = query.filter(extract('year', HarvestRecord.date) == year)
+        year_start, year_end = year_range(year)
+        query = query.where(HarvestRecord.date >= year_start, HarvestRecord.date < year_end)
     
     query = query.group_by(Variety.name).order_by(func.sum(HarvestRecord.kg_produced).desc())
     
-    results = query.all()
+    results = (await db.execute(query)).all()
     
     return [
         {
@@ -137,12 +217,69 @@ def get_stats_by_variety(
         }
         for r in results
     ]
+
+@router.get("/stats/combined")
+@cache(expire=STATS_EXPIRE, namespace=STATS_NAMESPACE, key_builder=query_key_builder)
+async def get_stats_combined(
+    year: Optional[int] = Query(None, description="Filtrer par année"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Statistiques globales + par variété en une seule requête
+    (GROUPING SETS : une seule lecture des récoltes pour les deux niveaux)
+    """
+    is_total = func.grouping(Variety.name)
+    
+    query = select(
+        Variety.name,
+        is_total.label('is_total'),
+        func.sum(HarvestRecord.kg_produced).label('total_kg_produced'),
+        # Arrondis du total calculés par PostgreSQL, comme /stats/summary (mêmes valeurs dans les deux réponses)
+        sql_round(func.sum(HarvestRecord.kg_produced)).label('rounded_total_kg_produced'),
+        sql_round(func.avg(HarvestRecord.kg_produced)).label('rounded_avg_kg_produced'),
+        func.count().label('total_records')
+    ).select_from(HarvestRecord).outerjoin(Variety)  # jointure externe : le total compte aussi les récoltes sans variété
+    
+    if year:
+        year_start, year_end = year_range(year)
+        query = query.where(HarvestRecord.date >= year_start, HarvestRecord.date < year_end)
+    
+    # Ligne de total (GROUPING = 1) en premier, puis les variétés par production décroissante
+    query = query.group_by(func.grouping_sets(tuple_(), tuple_(Variety.name))).order_by(
+        is_total.desc(),
+        func.sum(HarvestRecord.kg_produced).desc()
+    )
+    
+    results = (await db.execute(query)).all()
+    
+    summary = {"total_records": 0, "total_kg_produced": 0.0, "avg_kg_produced": 0.0}
+    by_variety = []
+    
+    for r in results:
+        if r.is_total:
+            summary = {
+                "total_records": r.total_records,
+                "total_kg_produced": r.rounded_total_kg_produced,
+                "avg_kg_produced": r.rounded_avg_kg_produced
+            }
+        elif r.name is not None:
+            # Récoltes sans variété : comptées dans le total seulement (absentes de /stats/by-variety)
+            by_variety.append({
+                "variety": r.name,
+                "total_kg_produced": float(r.total_kg_produced or 0),
+                "total_records": r.total_records
+            })
+    
+    return {
+        "summary": summary,
+        "by_variety": by_variety
+    }
     
 @router.get("/plant-configs", response_model=List[PlantConfigurationResponse])
-def get_plant_configurations(
+async def get_plant_configurations(
     variety_id: Optional[int] = Query(None, description="Filtrer par variété"),
     active_only: bool = Query(False, description="Seulement les configurations actives"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Récupère les configurations de plants
@@ -150,32 +287,28 @@ def get_plant_configurations(
     - active_only=True : Seulement les configs actives
     - variety_id : Filtrer par variété
     """
-    query = db.query(PlantConfiguration)
+    query = select(PlantConfiguration).options(joinedload(PlantConfiguration.variety, innerjoin=True))
     
     if variety_id:
-        query = query.filter(PlantConfiguration.variety_id == variety_id)
+        query = query.where(PlantConfiguration.variety_id == variety_id)
     
     if active_only:
         today = datetime.now().date()
-        query = query.filter(
-            or_(
-                PlantConfiguration.end_date.is_(None),
-                PlantConfiguration.end_date >= today
-            )
-        )
-    
-    configs = query.order_by(
+        query = query.where(active_until(PlantConfiguration.end_date) >= today)
+    
+    result = await db.execute(query.order_by(
         PlantConfiguration.variety_id,
         PlantConfiguration.start_date.desc()
-    ).all()
+    ))
+    configs = result.scalars().all()
     
     return configs
 
 
 @router.get("/plant-configs/current", response_model=List[PlantConfigurationResponse])
-def get_current_plant_configurations(
+async def get_current_plant_configurations(
     target_date: Optional[date] = Query(None, description="Date cible (défaut: aujourd'hui)"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Récupère la configuration de plants active pour une date donnée
@@ -183,49 +316,46 @@ def get_current_plant_configurations(
     if not target_date:
         target_date = datetime.now().date()
     
-    configs = db.query(PlantConfiguration).filter(
+    result = await db.execute(select(PlantConfiguration).options(joinedload(PlantConfiguration.variety, innerjoin=True)).where(
         PlantConfiguration.start_date <= target_date,
-        or_(
-            PlantConfiguration.end_date.is_(None),
-            PlantConfiguration.end_date >= target_date
-        )
-    ).all()
+        active_until(PlantConfiguration.end_date) >= target_date
+    ))
+    configs = result.scalars().all()
     
     return configs
 
 
 @router.post("/plant-configs", response_model=PlantConfigurationResponse, status_code=201)
-def create_plant_configuration(
+async def create_plant_configuration(
     config: PlantConfigurationCreate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Crée une nouvelle configuration de plants
     """
-    # Vérifier que la variété existe
-    variety = db.query(Variety).filter(Variety.id == config.variety_id).first()
-    if not variety:
-        raise HTTPException(status_code=404, detail="Variété non trouvée")
-    
-    # Créer la configuration
+    # Créer la configuration (l'existence de la variété est vérifiée par la clé étrangère)
     new_config = PlantConfiguration(**config.model_dump())
     db.add(new_config)
-    db.commit()
-    db.refresh(new_config)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="Variété non trouvée")
+    await db.refresh(new_config, attribute_names=['variety'])
     
     return new_config
 
 
 @router.put("/plant-configs/{config_id}", response_model=PlantConfigurationResponse)
-def update_plant_configuration(
+async def update_plant_configuration(
     config_id: int,
     config_update: PlantConfigurationUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Met à jour une configuration (fermer ou ajuster plants)
     """
-    config = db.query(PlantConfiguration).filter(PlantConfiguration.id == config_id).first()
+    config = await db.get(PlantConfiguration, config_id, options=[joinedload(PlantConfiguration.variety, innerjoin=True)])
     if not config:
         raise HTTPException(status_code=404, detail="Configuration non trouvée")
     
@@ -235,40 +365,41 @@ def update_plant_configuration(
     if config_update.plants_nbrs is not None:
         config.plants_nbrs = config_update.plants_nbrs
     
-    db.commit()
-    db.refresh(config)
+    await db.commit()
     
     return config
 
 @router.get("/predictions", response_model=List[PredictionResponse])
-def get_predictions(
+async def get_predictions(
     variety_id: Optional[int] = Query(None, description="Filtrer par variété"),
     target_date: Optional[date] = Query(None, description="Date cible"),
     limit: int = Query(100, description="Nombre maximum de résultats"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Récupère les prédictions avec filtres optionnels
     """
-    query = db.query(Prediction)
+    # lambda_stmt : SQL compilé mis en cache (voir harvest_rows_stmt)
+    query = lambda_stmt(lambda: select(Prediction).options(joinedload(Prediction.variety, innerjoin=True)))
     
     if variety_id:
-        query = query.filter(Prediction.variety_id == variety_id)
+        query += lambda s: s.where(Prediction.variety_id == variety_id)
     
     if target_date:
-        query = query.filter(Prediction.target_date == target_date)
+        query += lambda s: s.where(Prediction.target_date == target_date)
     
     # Tri par date de prédiction décroissante (plus récente d'abord)
-    query = query.order_by(Prediction.prediction_date.desc())
+    query += lambda s: s.order_by(Prediction.prediction_date.desc()).limit(limit)
     
-    predictions = query.limit(limit).all()
+    result = await db.execute(query)
+    predictions = result.scalars().all()
     
     return predictions
 
 @router.get("/predictions/latest", response_model=List[PredictionResponse])
-def get_latest_predictions(
+async def get_latest_predictions(
     days: int = Query(7, description="Nombre de jours à prédire"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Récupère les dernières prédictions pour les N prochains jours
@@ -278,22 +409,27 @@ def get_latest_predictions(
     
     today = datetime.now().date()
     
-    # Récupérer toutes les variétés
-    varieties = db.query(Variety).all()
-    
-    latest_predictions = []
-    
-    for variety in varieties:
-        for day_offset in range(1, days + 1):
-            target = today + timedelta(days=day_offset)
-            
-            # Prendre la prédiction la plus récente pour ce jour
-            pred = db.query(Prediction).filter(
-                Prediction.variety_id == variety.id,
-                Prediction.target_date == target
-            ).order_by(Prediction.prediction_date.desc()).first()
-            
-            if pred:
-                latest_predictions.append(pred)
+    # Classer les prédictions de chaque (variété, jour) de la plus récente à la plus ancienne
+    ranked = select(
+        Prediction.id,
+        func.row_number().over(
+            partition_by=(Prediction.variety_id, Prediction.target_date),
+            order_by=(Prediction.prediction_date.desc(), Prediction.id.desc())
+        ).label('rn')
+    ).where(
+        Prediction.target_date.between(today + timedelta(days=1), today + timedelta(days=days))
+    ).subquery()
+    
+    # Prendre la prédiction la plus récente pour chaque jour (une seule requête)
+    # Pas de V×D requêtes lancées via asyncio.gather : une AsyncSession n'exécute qu'une requête
+    # à la fois, et paralléliser sur plusieurs sessions mobiliserait V×D connexions du pool
+    result = await db.execute(
+        select(Prediction)
+        .join(ranked, Prediction.id == ranked.c.id)
+        .where(ranked.c.rn == 1)
+        .options(joinedload(Prediction.variety, innerjoin=True))
+        .order_by(Prediction.variety_id, Prediction.target_date)
+    )
+    latest_predictions = result.scalars().all()
     
     return latest_predictions
\ No newline at end of file
@@ -4,13 +4,21 @@ Script de validation des prédictions
 Compare les prédictions générées avec les vraies données de récolte
 """
 from datetime import date, timedelta
+from contextlib import redirect_stdout
+import io
+import sys
 from .database import SessionLocal
 from .models import Prediction, HarvestRecord, Variety
 from .prediction_service import generate_predictions
+import numpy as np
 import pandas as pd
-from sqlalchemy import func
+from sqlalchemy import select, and_, func
 
-def validate_predictions(test_date: date, days: int = 7, generate_first: bool = False):
+def round1(values: np.ndarray) -> np.ndarray:
+    """Arrondi à 0.1 identique à round() (np.round arrondit x*10 : 91.65 → 91.6 au lieu de 91.7)"""
+    return np.array([round(v, 1) for v in values.tolist()], dtype=float)
+
+def validate_predictions(test_date: date, days: int = 7, generate_first: bool = False, verbose: bool = True):
     """
     Valide les prédictions en les comparant avec les vraies données
     
@@ -18,7 +26,22 @@ def validate_predictions(test_date: date, days: int = 7, generate_first: bool =
         test_date: Date de référence pour le test
         days: Nombre de jours à prédire
         generate_first: Si True, génère d'abord les prédictions
+        verbose: Si False, le rapport n'est pas affiché (benchmarks, CI)
     """
+    # Rapport construit en mémoire puis écrit en une fois (pas d'écritures stdout entre les requêtes)
+    report = io.StringIO()
+    
+    try:
+        with redirect_stdout(report):
+            return _validate_predictions(test_date, days, generate_first)
+    finally:
+        if verbose:
+            sys.stdout.write(report.getvalue())
+            sys.stdout.flush()
+
+
+def _validate_predictions(test_date: date, days: int, generate_first: bool):
+    """Comparaison prédictions / réalité (rapport écrit sur stdout)"""
     
     print("\n" + "="*80)
     print("🔍 VALIDATION DES PRÉDICTIONS")
@@ -34,69 +57,89 @@ def validate_predictions(test_date: date, days: int = 7, generate_first: bool =
     db = SessionLocal()
     
     try:
-        results = []
-        
         print(f"📊 Comparaison prédictions vs réalité ({test_date + timedelta(days=1)} → {test_date + timedelta(days=days)})\n")
         
+        # Prédictions de la période et vraie récolte du même jour, en une seule requête
+        # (LEFT JOIN : les prédictions sans donnée réelle restent visibles)
+        query = select(
+            Prediction.target_date.label('date'),
+            Variety.name.label('variety'),
+            Prediction.harvest_fraction,
+            Prediction.kg_biological_predicted,
+            Prediction.kg_produced_predicted,
+            HarvestRecord.kg_produced.label('real_kg')
+        ).join(
+            Variety, Variety.id == Prediction.variety_id
+        ).outerjoin(
+            HarvestRecord, and_(
+                HarvestRecord.date == Prediction.target_date,
+                HarvestRecord.variety_id == Prediction.variety_id
+            )
+        ).where(
+            Prediction.target_date.between(test_date + timedelta(days=1), test_date + timedelta(days=days))
+        ).order_by(Prediction.target_date, Prediction.id)
+        
+        preds = pd.read_sql(query, db.bind)
+        
+        # Skip dimanche
+        preds = preds[pd.to_datetime(preds['date']).dt.weekday != 6]
+        
+        predicted_dates = set(preds['date'])
+        no_real = preds['real_kg'].isna()
+        
         for day_offset in range(1, days + 1):
             target = test_date + timedelta(days=day_offset)
-            
-            # Skip dimanche
             if target.weekday() == 6:
                 continue
-            
-            # Récupérer prédictions pour ce jour
-            preds = db.query(Prediction).filter(
-                Prediction.target_date == target
-            ).all()
-            
-            if not preds:
+            if target not in predicted_dates:
                 print(f"   ⚠️  {target} : Aucune prédiction trouvée")
                 continue
-            
-            for pred in preds:
-                # Récupérer la vraie récolte
-                real = db.query(HarvestRecord).filter(
-                    HarvestRecord.date == target,
-                    HarvestRecord.variety_id == pred.variety_id
-                ).first()
-                
-                if not real:
-                    print(f"   ⚠️  {target} : Pas de données réelles pour {pred.variety.name}")
-                    continue
-                
-                # Calculer erreurs
-                error_kg = pred.kg_produced_predicted - real.kg_produced
-                error_abs = abs(error_kg)
-                error_pct = (error_abs / real.kg_produced * 100) if real.kg_produced > 0 else 0
-                
-                # Calculer capacité biologique réelle
-                harvest_fraction = pred.harvest_fraction
-                kg_biological_real = real.kg_produced / harvest_fraction if harvest_fraction > 0 else 0
-                error_bio = pred.kg_biological_predicted - kg_biological_real
-                error_bio_abs = abs(error_bio)
-                
-                results.append({
-                    'date': target,
-                    'jour': ['Lun', 'Mar', 'Mer', 'Jeu', 'Ven', 'Sam', 'Dim'][target.weekday()],
-                    'variety': pred.variety.name,
-                    'fraction': f"{int(harvest_fraction * 100)}%",
-                    'bio_pred': round(pred.kg_biological_predicted, 1),
-                    'bio_real': round(kg_biological_real, 1),
-                    'error_bio': round(error_bio, 1),
-                    'prod_pred': round(pred.kg_produced_predicted, 1),
-                    'prod_real': round(real.kg_produced, 1),
-                    'error_kg': round(error_kg, 1),
-                    'error_abs': round(error_abs, 1),
-                    'error_pct': round(error_pct, 1)
-                })
-        
-        if not results:
+            for variety in preds.loc[no_real & (preds['date'] == target), 'variety']:
+                print(f"   ⚠️  {target} : Pas de données réelles pour {variety}")
+        
+        preds = preds[~no_real]
+        
+        if preds.empty:
             print("❌ Aucune donnée à comparer\n")
             return None
         
+        # Calculer erreurs (tableaux NumPy float64 contigus, une colonne par grandeur)
+        real_kg = preds['real_kg'].to_numpy(dtype=float)
+        pred_kg = preds['kg_produced_predicted'].to_numpy(dtype=float)
+        pred_bio = preds['kg_biological_predicted'].to_numpy(dtype=float)
+        harvest_fraction = preds['harvest_fraction'].to_numpy(dtype=float)
+        
+        error_kg = pred_kg - real_kg
+        error_abs = np.abs(error_kg)
+        error_pct = np.divide(error_abs, real_kg, out=np.zeros_like(real_kg), where=real_kg > 0) * 100
+        
+        # Calculer capacité biologique réelle
+        kg_biological_real = np.divide(real_kg, harvest_fraction, out=np.zeros_like(real_kg), where=harvest_fraction > 0)
+        error_bio = pred_bio - kg_biological_real
+        
+        # Valeurs arrondies (celles affichées et sauvegardées) sur lesquelles portent les métriques
+        r_error_kg = round1(error_kg)
+        r_error_abs = round1(error_abs)
+        r_error_pct = round1(error_pct)
+        r_error_bio = round1(error_bio)
+        
+        jours = np.array(['Lun', 'Mar', 'Mer', 'Jeu', 'Ven', 'Sam', 'Dim'])
+        
         # Créer DataFrame
-        df = pd.DataFrame(results)
+        df = pd.DataFrame({
+            'date': preds['date'].to_numpy(),
+            'jour': jours[pd.to_datetime(preds['date']).dt.weekday.to_numpy()],
+            'variety': preds['variety'].to_numpy(),
+            'fraction': np.char.add((harvest_fraction * 100).astype(int).astype(str), "%"),
+            'bio_pred': round1(pred_bio),
+            'bio_real': round1(kg_biological_real),
+            'error_bio': r_error_bio,
+            'prod_pred': round1(pred_kg),
+            'prod_real': round1(real_kg),
+            'error_kg': r_error_kg,
+            'error_abs': r_error_abs,
+            'error_pct': r_error_pct
+        })
         
         # Afficher résultats détaillés
         print("="*80)
@@ -116,16 +159,16 @@ def validate_predictions(test_date: date, days: int = 7, generate_first: bool =
         print("="*80)
         
         print(f"\n🎯 Performance sur PRODUCTION OBSERVÉE (kg_produced) :")
-        print(f"   MAE   : {df['error_abs'].mean():.2f} kg")
-        print(f"   RMSE  : {(df['error_kg']**2).mean()**0.5:.2f} kg")
-        print(f"   MAPE  : {df['error_pct'].mean():.2f}%")
-        print(f"   Max   : {df['error_abs'].max():.2f} kg")
-        print(f"   Min   : {df['error_abs'].min():.2f} kg")
-        print(f"   Médiane: {df['error_abs'].median():.2f} kg")
+        print(f"   MAE   : {r_error_abs.mean():.2f} kg")
+        print(f"   RMSE  : {np.sqrt((r_error_kg**2).mean()):.2f} kg")
+        print(f"   MAPE  : {r_error_pct.mean():.2f}%")
+        print(f"   Max   : {r_error_abs.max():.2f} kg")
+        print(f"   Min   : {r_error_abs.min():.2f} kg")
+        print(f"   Médiane: {np.median(r_error_abs):.2f} kg")
         
         print(f"\n🌱 Performance sur CAPACITÉ BIOLOGIQUE (kg_biological) :")
-        bio_mae = df['error_bio'].abs().mean()
-        bio_rmse = (df['error_bio']**2).mean()**0.5
+        bio_mae = np.abs(r_error_bio).mean()
+        bio_rmse = np.sqrt((r_error_bio**2).mean())
         print(f"   MAE   : {bio_mae:.2f} kg")
         print(f"   RMSE  : {bio_rmse:.2f} kg")
         
@@ -134,8 +177,8 @@ def validate_predictions(test_date: date, days: int = 7, generate_first: bool =
         print("📊 STATISTIQUES PAR VARIÉTÉ")
         print("="*80 + "\n")
         
-        for variety in df['variety'].unique():
-            variety_df = df[df['variety'] == variety]
+        # Un seul partitionnement par variété (au lieu d'un filtre complet par variété)
+        for variety, variety_df in df.groupby('variety', sort=False):
             print(f"{variety}:")
             print(f"   Prédictions : {len(variety_df)}")
             print(f"   MAE         : {variety_df['error_abs'].mean():.2f} kg")
@@ -149,9 +192,10 @@ def validate_predictions(test_date: date, days: int = 7, generate_first: bool =
         print("📅 STATISTIQUES PAR JOUR DE SEMAINE")
         print("="*80 + "\n")
         
+        jours_df = dict(tuple(df.groupby('jour')))
         for jour in ['Lun', 'Mar', 'Mer', 'Jeu', 'Ven', 'Sam']:
-            jour_df = df[df['jour'] == jour]
-            if len(jour_df) > 0:
+            jour_df = jours_df.get(jour)
+            if jour_df is not None:
                 print(f"{jour} (fraction {jour_df.iloc[0]['fraction']}):")
                 print(f"   MAE  : {jour_df['error_abs'].mean():.2f} kg")
                 print(f"   MAPE : {jour_df['error_pct'].mean():.2f}%")
@@ -162,16 +206,17 @@ def validate_predictions(test_date: date, days: int = 7, generate_first: bool =
         print("⚖️  ANALYSE DES BIAIS")
         print("="*80)
         
-        over = df[df['error_kg'] > 0]
-        under = df[df['error_kg'] < 0]
+        n_over = int((r_error_kg > 0).sum())
+        n_under = int((r_error_kg < 0).sum())
+        bias = r_error_kg.mean()
         
-        print(f"\nSur-estimations  : {len(over)} cas ({len(over)/len(df)*100:.1f}%)")
-        print(f"Sous-estimations : {len(under)} cas ({len(under)/len(df)*100:.1f}%)")
-        print(f"Biais moyen      : {df['error_kg'].mean():.2f} kg")
+        print(f"\nSur-estimations  : {n_over} cas ({n_over/len(df)*100:.1f}%)")
+        print(f"Sous-estimations : {n_under} cas ({n_under/len(df)*100:.1f}%)")
+        print(f"Biais moyen      : {bias:.2f} kg")
         
-        if df['error_kg'].mean() > 5:
+        if bias > 5:
             print("   ⚠️  Le modèle a tendance à SUR-ESTIMER la production")
-        elif df['error_kg'].mean() < -5:
+        elif bias < -5:
             print("   ⚠️  Le modèle a tendance à SOUS-ESTIMER la production")
         else:
             print("   ✅ Le modèle est bien calibré (peu de biais)")
@@ -233,8 +278,6 @@ def compare_multiple_periods():
 
 
 if __name__ == "__main__":
-    import sys
-    
     # Configuration par défaut
     TEST_DATE = date(2025, 4, 15)
     DAYS = 7
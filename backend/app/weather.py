@@ -1,9 +1,38 @@
 import requests
-import pandas as pd
+import numpy as np
+import csv
+import io
+import os
+from datetime import date
+from pathlib import Path
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from .database import SessionLocal, engine, Base
 from .models import WeatherData
 
+# Périodes téléchargées en parallèle (une par année)
+MAX_PARALLEL_FETCHES = 4
+
+# Périodes révolues (immuables) gardées sur disque : pas de nouveau téléchargement aux imports suivants
+WEATHER_CACHE_DIR = Path('/app/data/weather_cache')
+
+# Session HTTP partagée : une connexion keep-alive par téléchargement parallèle (une seule poignée TLS chacune)
+# Timeout (connexion, lecture) : un serveur muet ne bloque plus l'import indéfiniment
+HTTP_TIMEOUT = (5, 30)
+# Erreurs passagères (5xx de passerelle) réessayées avec attente exponentielle
+HTTP_RETRY = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=['GET'])
+_HTTP = requests.Session()
+_HTTP.headers.update({'User-Agent': 'strawberry-predictor', 'Accept-Encoding': 'gzip, deflate'})
+_HTTP.mount('https://', HTTPAdapter(
+    pool_connections=MAX_PARALLEL_FETCHES,
+    pool_maxsize=MAX_PARALLEL_FETCHES,
+    max_retries=HTTP_RETRY
+))
+
 def fetch_weather_data(latitude:float, longitude:float, start_date:str, end_date: str):
     """
     Récupère les données météo depuis Open-Meteo
@@ -34,27 +63,82 @@ def fetch_weather_data(latitude:float, longitude:float, start_date:str, end_date
         "timezone": "Europe/Paris"
     }
     
-    print(f"📡 Récupération météo de {start_date} à {end_date}...")
+    # Seules les périodes terminées sont mises en cache (l'année en cours évolue encore)
+    cache_path = WEATHER_CACHE_DIR / f"weather_{latitude}_{longitude}_{start_date}_{end_date}.json"
+    cacheable = date.fromisoformat(end_date) < date.today()
+    
+    if cacheable and cache_path.exists():
+        print(f"💾 Météo de {start_date} à {end_date} lue depuis le cache")
+        content = cache_path.read_bytes()
+    else:
+        print(f"📡 Récupération météo de {start_date} à {end_date}...")
+        
+        response = _HTTP.get(url, params=params, timeout=HTTP_TIMEOUT)
+        content = response.content
+        
+        if cacheable and response.status_code == 200:
+            # Écriture atomique : jamais de fichier de cache tronqué
+            WEATHER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix('.tmp')
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, cache_path)
+    
+    # JSON décodé par orjson (C) plutôt que json de la stdlib
+    # Réponse journalière (~365 valeurs par champ) : décodage en une fois, pas de parseur incrémental
+    data = orjson.loads(content)
+    daily = data['daily']
+    
+    # Colonnes de WeatherData, gardées sous forme de listes (réponse déjà par colonnes, pas de DataFrame)
+    # Pas de tableau NumPy structuré : les null deviendraient NaN, à reconvertir en champs vides pour COPY
+    weather = {
+        'date': daily['time'],  # Chaînes ISO transmises telles quelles à COPY (aucune conversion par ligne)
+        'temperature_max': daily['temperature_2m_max'],
+        'temperature_min': daily['temperature_2m_min'],
+        'temperature_mean': daily['temperature_2m_mean'],
+        'humidity_mean': daily['relative_humidity_2m_mean'],
+        'precipitation': daily['precipitation_sum'],
+        'sunshine_duration': (np.nan_to_num(np.array(daily['sunshine_duration'], dtype=float)) / 3600).tolist(),  # secondes → heures (None → 0)
+        'solar_radiation': daily['shortwave_radiation_sum']
+    }
+    
+    print(f"✅ {len(weather['date'])} jours récupérés")
     
-    response = requests.get(url, params=params)
+    return weather
+
+def _copy_weather(db: Session, weather: dict) -> int:
+    """
+    Insère les jours d'une période via COPY (chemin d'ingestion le plus rapide de PostgreSQL)
+    COPY ne gère pas ON CONFLICT : chargement dans une table temporaire, puis
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING (les jours déjà en base sont ignorés)
     
-    data = response.json()
+    Returns:
+        Nombre de jours ajoutés
+    """
+    columns = ", ".join(weather)
     
-    # Convertir en DataFrame
-    df = pd.DataFrame({
-        'date': pd.to_datetime(data['daily']['time']),
-        'temperature_max': data['daily']['temperature_2m_max'],
-        'temperature_min': data['daily']['temperature_2m_min'],
-        'temperature_mean': data['daily']['temperature_2m_mean'],
-        'humidity_mean': data['daily']['relative_humidity_2m_mean'],
-        'precipitation': data['daily']['precipitation_sum'],
-        'sunshine_duration': [h / 3600 if h else 0 for h in data['daily']['sunshine_duration']],  # secondes → heures
-        'solar_radiation': data['daily']['shortwave_radiation_sum']
-    })
+    # Colonnes → lignes CSV en mémoire (None → champ vide = NULL)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(zip(*weather.values()))
+    buffer.seek(0)
     
-    print(f"✅ {len(df)} jours récupérés")
+    # Curseur psycopg2 de la transaction en cours
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS weather_staging ON COMMIT DROP AS "
+            f"SELECT {columns} FROM weather_data WITH NO DATA"
+        )
+        cursor.copy_expert(f"COPY weather_staging ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO weather_data ({columns}) SELECT {columns} FROM weather_staging "
+            f"ON CONFLICT (date) DO NOTHING"
+        )
+        imported = cursor.rowcount
+        cursor.execute("TRUNCATE weather_staging")
+    finally:
+        cursor.close()
     
-    return df
+    return imported
 
 def import_weather_data(latitude: float = 43.1397, longitude: float = 6.1556):
     """
@@ -81,37 +165,31 @@ def import_weather_data(latitude: float = 43.1397, longitude: float = 6.1556):
         
         total_imported = 0
         
-        for start_date, end_date in periods:
-            df = fetch_weather_data(latitude, longitude, start_date, end_date)
-            
-            if df is None:
+        # Téléchargement des périodes en parallèle (attente réseau), insertion ensuite dans la session unique
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_FETCHES) as executor:
+            weathers = list(executor.map(
+                lambda period: fetch_weather_data(latitude, longitude, *period),
+                periods
+            ))
+        
+        for (start_date, end_date), weather in zip(periods, weathers):
+            if weather is None:
                 continue
             
-            for _, row in df.iterrows():
-                existing = db.query(WeatherData).filter(
-                    WeatherData.date == row['date'].date()
-                ).first()
-                
-                if existing:
-                    continue
-                
-                weather = WeatherData(
-                    date=row['date'].date(),
-                    temperature_max=row['temperature_max'],
-                    temperature_min=row['temperature_min'],
-                    temperature_mean=row['temperature_mean'],
-                    humidity_mean=row['humidity_mean'],
-                    precipitation=row['precipitation'],
-                    sunshine_duration=row['sunshine_duration'],
-                    solar_radiation=row['solar_radiation']
-                )
-                db.add(weather)
-                total_imported += 1
+            total_imported += _copy_weather(db, weather)
             
-            db.commit()
             print(f"✅ Période {start_date} à {end_date} importée")
         
-        total_weather = db.query(WeatherData).count()
+        # Une seule transaction pour toutes les périodes (un seul commit)
+        db.commit()
+        
+        # Statistiques rafraîchies après le chargement en masse (échantillon borné, pas de parcours complet),
+        # puis total lu dans le catalogue plutôt que par un COUNT(*) sur toute la table
+        db.execute(text("ANALYZE weather_data"))
+        total_weather = db.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'weather_data'::regclass")
+        ).scalar()
+        db.commit()
         
         print("\n" + "="*60)
         print(f"📊 STATISTIQUES")